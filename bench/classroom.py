@@ -0,0 +1,196 @@
+"""Classroom load test: N students take a test at once against one worker.
+
+Drives the real router handlers (test_start, test_pin, test_name,
+answer_selected, navigate, finish_confirm/finish_yes -> finish_test) with
+synthetic updates, using the in-memory stand-ins from bench/fakes.py.
+
+    python -m bench.classroom --students 200 --questions 10 \
+        --mongo-latency 0.005 --api-latency 0.05 --json bench_output.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import pickle
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from bench.fakes import load_bot
+
+GRADE = 7
+TOPIC = "Bench mavzu"
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Classroom:
+    def __init__(self, module, fake, args):
+        self.m = module
+        self.fake = fake
+        self.args = args
+        self.ids = itertools.count(1)
+        self.latencies = []
+        self.clicks = 0
+
+    async def seed(self):
+        m = self.m
+        questions = [{
+            "text": f"Savol {i}: jism tezligi qancha?",
+            "options": [f"{i} m/s", f"{i + 1} m/s", f"{i + 2} m/s", f"{i + 3} m/s"],
+            "answer": 0,
+            "images": [],
+            "type": "choice",
+            "explanation": "",
+            "grade": GRADE,
+            "topic": TOPIC,
+            "difficulty": "Bilish",
+            "created_at": datetime.now(),
+        } for i in range(self.args.pool)]
+        await m.questions_col.insert_many(questions)
+        pins = [{
+            "pin": f"{10000000 + i}",
+            "batch_id": "bench",
+            "number": i + 1,
+            "grade": GRADE,
+            "topic": TOPIC,
+            "created_by": 1,
+            "created_at": datetime.now(),
+            "expires_at": datetime.now() + timedelta(days=1),
+            "active": True,
+            "multi_use": False,
+            "max_attempts": 1,
+            "used_count": 0,
+            "used_by": [],
+            "question_count": self.args.questions,
+            "time_limit": 30,
+        } for i in range(self.args.students)]
+        await m.pins_col.insert_many(pins)
+        if self.args.forms:
+            m.TEST_FORMS = self.args.forms
+            await m.build_test_forms("bench", GRADE, TOPIC, self.args.questions, datetime.now() + timedelta(days=1))
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"Oquvchi{uid}"}
+
+    def message(self, uid, text):
+        n = next(self.ids)
+        return self.m.Update.model_validate({
+            "update_id": n,
+            "message": {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                        "from": self._user(uid), "text": text},
+        }, context={"bot": self.m.bot})
+
+    def callback(self, uid, data):
+        n = next(self.ids)
+        return self.m.Update.model_validate({
+            "update_id": n,
+            "callback_query": {
+                "id": str(n), "from": self._user(uid), "chat_instance": str(uid), "data": data,
+                "message": {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                            "from": {"id": self.m.bot.id, "is_bot": True, "first_name": "Bot"},
+                            "text": "📍 Navigatsiya:"},
+            },
+        }, context={"bot": self.m.bot})
+
+    async def feed(self, update):
+        start = time.perf_counter()
+        await self.m.dp.feed_update(self.m.bot, update)
+        self.latencies.append(time.perf_counter() - start)
+        self.clicks += 1
+        if self.args.think:
+            await asyncio.sleep(random.uniform(0, 2 * self.args.think))
+
+    def key(self, uid):
+        from aiogram.fsm.storage.base import StorageKey
+        return StorageKey(bot_id=self.m.bot.id, chat_id=uid, user_id=uid)
+
+    async def start_test(self, uid, pin):
+        await self.feed(self.message(uid, "📝 Test boshlash"))
+        await self.feed(self.message(uid, pin))
+        await self.feed(self.message(uid, f"O'quvchi {uid}"))
+        data = await self.m.dp.storage.get_data(self.key(uid))
+        return data["session"]
+
+    async def take_test(self, uid, session):
+        test_id = session["test_id"]
+        total = len(session["questions"])
+        for i in range(total):
+            answer = random.randrange(len(session["questions"][i]["options"]))
+            await self.feed(self.callback(uid, f"ans_{test_id}_{i}_{answer}"))
+            if i < total - 1:
+                await self.feed(self.callback(uid, f"nav_{test_id}_next"))
+        await self.feed(self.callback(uid, f"finish_{test_id}"))
+        if "session" in await self.m.dp.storage.get_data(self.key(uid)):
+            await self.feed(self.callback(uid, f"finishyes_{test_id}"))
+
+    async def run(self):
+        await self.seed()
+        students = [(1_000_000 + i, f"{10000000 + i}") for i in range(self.args.students)]
+
+        tracemalloc.start()
+        base_mem, _ = tracemalloc.get_traced_memory()
+        t0 = time.perf_counter()
+        sessions = await asyncio.gather(*(self.start_test(uid, pin) for uid, pin in students))
+        start_phase = time.perf_counter() - t0
+        live_mem, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        session_bytes = [len(pickle.dumps(s)) for s in sessions]
+
+        t1 = time.perf_counter()
+        await asyncio.gather(*(self.take_test(uid, s) for (uid, _), s in zip(students, sessions)))
+        test_phase = time.perf_counter() - t1
+
+        results = await self.m.results_col.count_documents({})
+        return {
+            "students": self.args.students,
+            "questions": self.args.questions,
+            "mongo_latency": self.args.mongo_latency,
+            "api_latency": self.args.api_latency,
+            "results_recorded": results,
+            "clicks": self.clicks,
+            "start_phase_s": round(start_phase, 3),
+            "test_phase_s": round(test_phase, 3),
+            "throughput_clicks_per_s": round(self.clicks / (start_phase + test_phase), 1),
+            "latency_p50_ms": round(percentile(self.latencies, 0.50) * 1000, 2),
+            "latency_p99_ms": round(percentile(self.latencies, 0.99) * 1000, 2),
+            "api_calls_per_click": round(self.fake.total_calls / self.clicks, 2),
+            "api_calls": dict(self.fake.calls.most_common()),
+            "session_pickle_bytes_avg": int(sum(session_bytes) / len(session_bytes)),
+            "heap_bytes_per_session": int((live_mem - base_mem) / self.args.students),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--questions", type=int, default=10, help="questions per test")
+    parser.add_argument("--pool", type=int, default=40, help="questions in the topic")
+    parser.add_argument("--mongo-latency", type=float, default=0.0, help="seconds per Mongo call")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per Bot API call")
+    parser.add_argument("--forms", type=int, default=0, help="precompiled test forms for the batch, 0 = off")
+    parser.add_argument("--think", type=float, default=0.0, help="mean pause between clicks, seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    module, fake, _ = load_bot(args.mongo_latency, args.api_latency)
+    report = asyncio.run(Classroom(module, fake, args).run())
+
+    handler_summary = module.metrics.summary()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    print(handler_summary.replace("<b>", "").replace("</b>", ""))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
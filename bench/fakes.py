@@ -0,0 +1,175 @@
+"""In-memory stand-ins for the Telegram Bot API and MongoDB used by the benchmarks.
+
+`load_bot()` imports bot.py with a fake token, swaps every Motor collection for
+a mongomock-backed async wrapper and the Bot API session for `FakeSession`.
+Both stand-ins take an injectable latency so a run can model a slow Atlas
+cluster or a slow Telegram round trip.
+"""
+import asyncio
+import itertools
+import os
+import sys
+import time
+import typing
+from collections import Counter
+
+import mongomock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeCursor:
+    def __init__(self, cursor, latency: float):
+        self._cursor = cursor
+        self._latency = latency
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, n):
+        self._cursor = self._cursor.limit(n)
+        return self
+
+    def skip(self, n):
+        self._cursor = self._cursor.skip(n)
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    async def to_list(self, length=None):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        docs = list(self._cursor)
+        return docs if length is None else docs[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        for doc in self._cursor:
+            yield doc
+
+
+class FakeCollection:
+    """Motor-like async facade over a mongomock collection."""
+
+    def __init__(self, collection, latency: float = 0.0, stats: Counter = None):
+        self._col = collection
+        self._latency = latency
+        self._stats = stats if stats is not None else Counter()
+        self.name = collection.name
+
+    def __getattr__(self, attr):
+        target = getattr(self._col, attr)
+        if not callable(target):
+            return target
+
+        async def call(*args, **kwargs):
+            self._stats[f"{self.name}.{attr}"] += 1
+            if self._latency:
+                await asyncio.sleep(self._latency)
+            return target(*args, **kwargs)
+        return call
+
+    def with_options(self, **kwargs):
+        return self
+
+    def find(self, *args, **kwargs):
+        self._stats[f"{self.name}.find"] += 1
+        return FakeCursor(self._col.find(*args, **kwargs), self._latency)
+
+    def aggregate(self, pipeline, **kwargs):
+        self._stats[f"{self.name}.aggregate"] += 1
+        return FakeCursor(iter(self._col.aggregate(pipeline, **kwargs)), self._latency)
+
+
+class FakeSession:
+    """Bot API session that answers every method locally and counts calls."""
+
+    def __init__(self, latency: float = 0.0):
+        from aiogram.client.session.base import BaseSession
+
+        class _Session(BaseSession):
+            async def close(inner):
+                pass
+
+            async def make_request(inner, bot, method, timeout=None):
+                return await self._make_request(bot, method)
+
+            async def stream_content(inner, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+                yield b""
+
+        self.session = _Session()
+        self.latency = latency
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+
+    async def _make_request(self, bot, method):
+        from aiogram.types import Message, User, File
+
+        name = type(method).__name__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        returning = method.__returning__
+        if returning is Message:
+            return self._message(bot, method)
+        if returning is User:
+            return User(id=bot.id, is_bot=True, first_name="Bench", username="bench_bot")
+        if returning is File:
+            return File(file_id="bench", file_unique_id="bench", file_path="bench")
+        if typing.get_origin(returning) is list:
+            return []
+        return True
+
+    def _message(self, bot, method):
+        from aiogram.types import Message
+
+        message_id = next(self._ids)
+        data = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": getattr(method, "chat_id", 0), "type": "private"},
+            "text": getattr(method, "text", None) or getattr(method, "caption", None) or "",
+        }
+        if hasattr(method, "document"):
+            data["document"] = {"file_id": f"doc{message_id}", "file_unique_id": f"doc{message_id}"}
+        if hasattr(method, "photo"):
+            data["photo"] = [{"file_id": f"photo{message_id}", "file_unique_id": f"photo{message_id}",
+                              "width": 1, "height": 1}]
+        return Message.model_validate(data, context={"bot": bot})
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+def load_bot(mongo_latency: float = 0.0, api_latency: float = 0.0):
+    """Import bot.py against the stand-ins. Returns (module, fake_session, mongo_stats)."""
+    os.environ["BOT_TOKEN"] = "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH"
+    os.environ["MONGO_URI"] = "mongodb://localhost:27017"
+    os.environ["FSM_STORAGE"] = "memory"
+    os.environ["WORKERS"] = "1"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    import bot as module
+    from motor.motor_asyncio import AsyncIOMotorCollection
+
+    mongo = mongomock.MongoClient()[module.DB_NAME]
+    stats = Counter()
+    for attr, value in list(vars(module).items()):
+        if isinstance(value, AsyncIOMotorCollection):
+            setattr(module, attr, FakeCollection(mongo[value.name], mongo_latency, stats))
+
+    fake = FakeSession(api_latency)
+    fake.session.middleware(module.ApiTimingMiddleware())
+    module.bot.session = fake.session
+    if module.router.parent_router is None:
+        module.dp.include_router(module.router)
+    return module, fake, stats
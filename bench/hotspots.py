@@ -0,0 +1,183 @@
+"""Micro-benchmarks for the CPU-heavy functions in bot.py.
+
+Fixtures are generated on the fly: .docx files with N questions and M
+images, images of several sizes, and result sets of 10/100/1000 rows.
+Each case reports the median wall time over --repeat runs and the
+tracemalloc peak of one extra run.
+
+    python -m bench.hotspots                     # compare with bench/baseline.json
+    python -m bench.hotspots --update-baseline   # record a new baseline
+    python -m bench.hotspots --only pdf --quick
+
+The exit status is 1 when a case is slower (or uses more memory) than the
+baseline by more than --threshold.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from bench.fakes import load_bot
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+# ---------- fixtures ----------
+def make_image(width: int, height: int, seed: int = 0) -> bytes:
+    """Noisy PNG - compresses like a scanned diagram, not like a flat colour."""
+    from PIL import Image
+    rnd = random.Random(seed)
+    img = Image.new("RGB", (width, height), "white")
+    px = img.load()
+    for _ in range(width * height // 20):
+        px[rnd.randrange(width), rnd.randrange(height)] = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+def make_docx(path: str, questions: int, images: int):
+    from docx import Document
+    from docx.shared import Cm
+    doc = Document()
+    with_image = set(random.Random(questions).sample(range(questions), min(images, questions)))
+    for i in range(questions):
+        doc.add_paragraph(f"{i + 1}. Jism {i} m/s tezlik bilan harakatlanmoqda. Kinetik energiyani toping.")
+        if i in with_image:
+            doc.add_picture(io.BytesIO(make_image(640, 480, seed=i)), width=Cm(6))
+        for letter in "ABCD":
+            doc.add_paragraph(f"{letter}) {random.randint(1, 500)} J")
+        doc.add_paragraph("Javob: B")
+    doc.save(path)
+
+
+def make_results(rows: int, questions: int = 10) -> list:
+    rnd = random.Random(rows)
+    now = datetime.now()
+    results = []
+    for i in range(rows):
+        details = [{"q": f"Savol {j}: jismning massasi va tezligi berilgan, impulsni toping", "user": rnd.randrange(4),
+                    "correct": rnd.randrange(4), "ok": rnd.random() < 0.6} for j in range(questions)]
+        correct = sum(d["ok"] for d in details)
+        results.append({
+            "user_name": f"O'quvchi {i}", "grade": 7, "topic": "Mexanika", "pin": "12345678",
+            "score": round(correct / questions * 100, 1), "correct": correct, "total": questions,
+            "time_seconds": rnd.uniform(120, 1800), "completed_at": now - timedelta(minutes=i), "details": details,
+        })
+    return results
+
+
+def make_pins(count: int) -> tuple:
+    pins = [{"pin": f"{10000000 + i}", "number": i + 1} for i in range(count)]
+    info = {"grade": 7, "topic": "Mexanika", "question_count": 10, "time_limit": 30,
+            "multi_use": False, "max_attempts": 1}
+    return pins, info
+
+
+# ---------- cases ----------
+def build_cases(m, quick: bool, tmpdir: str) -> dict:
+    cases = {}
+
+    docx_sizes = [(20, 0), (50, 10)] if quick else [(20, 0), (100, 10), (200, 50)]
+    for n, k in docx_sizes:
+        path = os.path.join(tmpdir, f"q{n}_i{k}.docx")
+        make_docx(path, n, k)
+        cases[f"docx.parse[q={n},img={k}]"] = lambda path=path: asyncio.run(m.parse_word_with_images(path))
+
+    for w, h in [(320, 240), (1600, 1200)] if quick else [(320, 240), (1600, 1200), (4000, 3000)]:
+        data = make_image(w, h, seed=w)
+        cases[f"image.compress[{w}x{h}]"] = lambda data=data: m.compress_image(data)
+
+    for count in (10, 100) if quick else (10, 100, 1000):
+        pins, info = make_pins(count)
+        cases[f"pdf.pins[{count}]"] = lambda pins=pins, info=info: m.generate_pins_pdf(pins, info)
+        cases[f"pdf.pins_qr[{count}]"] = lambda pins=pins, info=info: m.generate_pins_pdf(pins, info, "bench_bot")
+
+    for rows in (10, 100) if quick else (10, 100, 1000):
+        results = make_results(rows)
+        cases[f"pdf.summary[{rows}]"] = lambda r=results: m.generate_summary_report(r)
+        cases[f"pdf.detailed[{rows}]"] = lambda r=results: m.generate_detailed_student_report(r)
+    return cases
+
+
+def measure(func, repeat: int) -> dict:
+    func()  # warmup: imports, font caches
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"median_s": round(statistics.median(times), 5), "min_s": round(min(times), 5), "peak_bytes": peak}
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for name, result in current.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        for metric in ("median_s", "peak_bytes"):
+            if old[metric] and result[metric] > old[metric] * (1 + threshold):
+                regressions.append(f"{name} {metric}: {old[metric]} -> {result[metric]} "
+                                   f"(+{(result[metric] / old[metric] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="run cases whose name contains this substring")
+    parser.add_argument("--quick", action="store_true", help="smaller fixtures")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    args = parser.parse_args()
+    random.seed(0)
+
+    m, _, _ = load_bot()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, func in build_cases(m, args.quick, tmpdir).items():
+            if args.only and args.only not in name:
+                continue
+            results[name] = measure(func, args.repeat)
+            r = results[name]
+            print(f"{name:32} {r['median_s'] * 1000:10.1f} ms  peak {r['peak_bytes'] / 1024:10.0f} KB")
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline saved: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline yet - run with --update-baseline")
+        return
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    if regressions:
+        print("\nREGRESSIONS:")
+        print("\n".join(f"  {r}" for r in regressions))
+        sys.exit(1)
+    print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,37 +5,58 @@ import re
 import random
 import string
 import hashlib
+import hmac
+import secrets
+import unicodedata
 import json
+import pickle
+import multiprocessing
+import logging
+import logging.handlers
+import queue
+import atexit
+import mmap
+from collections import OrderedDict
+import contextvars
+import threading
+import bisect
+import time
+BOOT_TS = time.monotonic()  # noqa: E402 - jarayon boshidan (importlar ham) o'lchanadi
+from contextlib import asynccontextmanager, contextmanager
+from functools import wraps
 from datetime import datetime, timedelta
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 import base64
+import gzip
+from itertools import islice
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
 from aiogram.types import (
-    Message, CallbackQuery, BufferedInputFile,
+    Message, CallbackQuery, BufferedInputFile, FSInputFile, Update,
     InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup,
     KeyboardButton, ReplyKeyboardRemove
 )
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiohttp import web
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
 
-from docx import Document
-from docx.oxml import parse_xml
 from motor.motor_asyncio import AsyncIOMotorClient
-from bson import ObjectId
+from pymongo import monitoring, UpdateOne
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId, json_util
 
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import cm
 
-from PIL import Image as PILImage
 
 # ================= CONFIG =================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -46,29 +67,463 @@ ADMIN_IDS = [int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.
 DEFAULT_QUESTION_COUNT = int(os.getenv("DEFAULT_QUESTION_COUNT", 10))
 DEFAULT_TIME_LIMIT = int(os.getenv("DEFAULT_TIME_LIMIT", 30))
 PIN_EXPIRY_DAYS = int(os.getenv("PIN_EXPIRY_DAYS", 7))
+PIN_BATCH_MAX = int(os.getenv("PIN_BATCH_MAX", 5000))
+PIN_INSERT_CHUNK = int(os.getenv("PIN_INSERT_CHUNK", 500))
+PIN_PDF_PART = int(os.getenv("PIN_PDF_PART", 500))  # bitta PDF fayldagi PIN'lar
+PIN_CACHE_TTL = float(os.getenv("PIN_CACHE_TTL", 30))  # topilgan PIN hujjati, soniya
+PIN_NEGATIVE_TTL = float(os.getenv("PIN_NEGATIVE_TTL", 60))  # topilmagan PIN
+PIN_CACHE_SIZE = int(os.getenv("PIN_CACHE_SIZE", 10000))
+PIN_ATTEMPTS = int(os.getenv("PIN_ATTEMPTS", 5))  # noto'g'ri PIN'lar soni PIN_ATTEMPT_WINDOW ichida
+PIN_ATTEMPT_WINDOW = float(os.getenv("PIN_ATTEMPT_WINDOW", 60))
+SESSION_DRAIN_SECONDS = float(os.getenv("SESSION_DRAIN_SECONDS", 2))  # majburiy yakunlashlarni tekshirish
+DASHBOARD_SECONDS = float(os.getenv("DASHBOARD_SECONDS", 5))  # jonli panel tahrirlari orasidagi eng kam vaqt
+TEST_FORMS = int(os.getenv("TEST_FORMS", 8))  # PIN to'plami uchun oldindan tuzilgan variantlar, 0 - o'chiq
 MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", 50000))
 MAX_IMAGE_DIMENSION = int(os.getenv("MAX_IMAGE_DIMENSION", 800))
+IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", 32 * 1024 * 1024))
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "")  # bo'sh - disk kesh o'chiq
+ARTIFACT_CACHE_BYTES = int(os.getenv("ARTIFACT_CACHE_BYTES", 16 * 1024 * 1024))  # hisobot/PIN fayllari, xotira
+ARTIFACT_CACHE_DIR = os.getenv("ARTIFACT_CACHE_DIR", "")  # bo'sh - disk kesh o'chiq
+ARTIFACT_DISK_BYTES = int(os.getenv("ARTIFACT_DISK_BYTES", 256 * 1024 * 1024))
+PHASH_THRESHOLD = int(os.getenv("PHASH_THRESHOLD", -1))  # Hamming masofa (64 bit, 0-2 tavsiya), -1 - o'chiq
+
+# MongoDB pool va yozish kafolatlari
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_MS = int(os.getenv("MONGO_MAX_IDLE_MS", 300000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000))
+MONGO_W_FAST = os.getenv("MONGO_W_FAST", "1")
+
+# Ko'p jarayonli rejim: update'lar chat_id bo'yicha WORKERS ta jarayonga bo'linadi
+WORKERS = max(1, int(os.getenv("WORKERS", 1)))
+FSM_STORAGE = os.getenv("FSM_STORAGE", "mongo" if WORKERS > 1 else "memory")
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 100))
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # 0 - HTTP endpoint o'chiq
+
+# Word import: bosqichma-bosqich saqlash (savollar soni) va progress yangilash oralig'i
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK", 50))
+IMPORT_PROGRESS_SECONDS = float(os.getenv("IMPORT_PROGRESS_SECONDS", 3))
+BACKUP_CHUNK = int(os.getenv("BACKUP_CHUNK", 100))  # backup eksport/import: bir bo'lakdagi qatorlar
+
+INDEX_DIAGNOSTICS = os.getenv("INDEX_DIAGNOSTICS", "0") == "1"  # startda explain() bilan tekshirish
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))  # har bir rasm/paragraf debug yozuvlari ulushi
 
 if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN topilmadi!")
 
+# ================= LOGGING =================
+log_user_id = contextvars.ContextVar("user_id", default=None)
+log_test_id = contextvars.ContextVar("test_id", default=None)
+
+class ContextFilter(logging.Filter):
+    """user_id/test_id ni qo'shish va `sampled` debug yozuvlarini kamaytirish"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sampled", False) and random.random() >= LOG_SAMPLE_RATE:
+            return False
+        record.user_id = log_user_id.get()
+        record.test_id = log_test_id.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    SKIP = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "sampled", "user_id", "test_id"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "pid": record.process,
+            "msg": record.getMessage(),
+        }
+        if record.user_id is not None:
+            entry["user_id"] = record.user_id
+        if record.test_id is not None:
+            entry["test_id"] = record.test_id
+        entry.update({k: v for k, v in vars(record).items() if k not in self.SKIP})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # formatlash (json.dumps, traceback) listener oqimida bajariladi
+
+def setup_logging():
+    """Event loop stdout'ga yozib to'xtab qolmasligi uchun - navbat + alohida oqim"""
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())  # kontekst navbatga qo'yishdan oldin olinadi
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
+log = logging.getLogger("fizika")
+
+# ================= METRICS =================
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Taxminiy kvantil - bucket yuqori chegarasi"""
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics:
+    """Counter va histogramlar - Prometheus text formatida chiqariladi"""
+
+    def __init__(self):
+        self.counters: Dict[tuple, float] = {}
+        self.histograms: Dict[tuple, Histogram] = {}
+        self.gauges: Dict[tuple, float] = {}
+        self.lock = threading.Lock()  # pymongo listener'lari boshqa oqimdan chaqiriladi
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name: str, delta: float, **labels):
+        """Gauge (masalan, band ulanishlar soni)"""
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted({**self.counters, **self.gauges}.items()):
+                lines.append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), hist in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(Histogram.BUCKETS, hist.counts):
+                    cumulative += n
+                    le = f'le="{bound}"'
+                    lines.append(f"{name}_bucket{self._labels(labels, le)} {cumulative}")
+                le = 'le="+Inf"'
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {hist.count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {hist.sum}")
+                lines.append(f"{name}_count{self._labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, limit: int = 8) -> str:
+        """Admin uchun qisqa ko'rinish: har bir histogram bo'yicha eng ko'p chaqirilganlar"""
+        groups: Dict[str, list] = {}
+        with self.lock:
+            for (name, labels), hist in self.histograms.items():
+                groups.setdefault(name, []).append((labels, hist))
+            gauges = sorted(self.gauges.items())
+        text = ""
+        for (name, labels), value in gauges:
+            text += f"{name}{self._labels(labels)}: {value:g}\n"
+        for name, series in sorted(groups.items()):
+            text += f"\n<b>{name}</b>\n"
+            for labels, hist in sorted(series, key=lambda x: -x[1].count)[:limit]:
+                label = ",".join(str(v) for _, v in labels) or "-"
+                text += (f"  {label}: n={hist.count} p50={hist.quantile(0.5) * 1000:.0f}ms "
+                         f"p99={hist.quantile(0.99) * 1000:.0f}ms max={hist.max * 1000:.0f}ms\n")
+        return text or "Ma'lumot yo'q"
+
+metrics = Metrics()
+
+def timed(name: str, **labels):
+    """Sinxron (CPU) funksiyalar vaqtini o'lchash uchun dekorator"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Har bir Mongo buyrug'ining kolleksiya bo'yicha kechikishi"""
+
+    def __init__(self):
+        self.pending: Dict[tuple, str] = {}
+
+    def started(self, event):
+        coll = event.command.get(event.command_name)
+        self.pending[(event.connection_id, event.request_id)] = coll if isinstance(coll, str) else "-"
+
+    def succeeded(self, event):
+        coll = self.pending.pop((event.connection_id, event.request_id), "-")
+        metrics.observe("mongo_command_seconds", event.duration_micros / 1e6,
+                        command=event.command_name, collection=coll)
+
+    def failed(self, event):
+        coll = self.pending.pop((event.connection_id, event.request_id), "-")
+        metrics.inc("mongo_command_errors_total", command=event.command_name, collection=coll)
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Pool'dan ulanish olishni kutish vaqti va band ulanishlar"""
+
+    def connection_checked_out(self, event):
+        metrics.observe("mongo_pool_wait_seconds", event.duration)
+        metrics.add("mongo_pool_in_use", 1)
+
+    def connection_checked_in(self, event):
+        metrics.add("mongo_pool_in_use", -1)
+
+    def connection_check_out_failed(self, event):
+        metrics.inc("mongo_pool_checkout_failed_total", reason=event.reason)
+
+    def connection_check_out_started(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+
+@contextmanager
+def handler_timer(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("bot_handler_errors_total", handler=name)
+        raise
+    finally:
+        metrics.observe("bot_handler_seconds", time.perf_counter() - start, handler=name)
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Har bir handler vaqti (filter o'tgandan keyin)"""
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        with handler_timer(data["handler"].callback.__name__):
+            return await handler(event, data)
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    """Bot API chaqiruvlari vaqti - metod bo'yicha"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            metrics.inc("telegram_api_errors_total", method=name)
+            raise
+        finally:
+            metrics.observe("telegram_api_seconds", time.perf_counter() - start, method=name)
+
+async def start_metrics_server(port: int):
+    """Prometheus uchun /metrics endpoint"""
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain")
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    log.info("Metrics endpoint: http://0.0.0.0:%d/metrics", port)
+
 # ================= DATABASE =================
+# Har bir jarayon (worker) modulni qayta import qiladi va o'z Motor pool'iga ega bo'ladi
 client = AsyncIOMotorClient(
     MONGO_URI,
     serverSelectionTimeoutMS=30000,
     connectTimeoutMS=30000,
     socketTimeoutMS=30000,
     retryWrites=True,
-    w="majority"
+    w="majority",
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    event_listeners=[MongoCommandListener(), MongoPoolListener()]
 )
 db = client[DB_NAME]
 
-questions_col = db.questions
-results_col = db.results
-pins_col = db.pins
-users_col = db.users
-images_col = db.images
-pin_batches_col = db.pin_batches
+# Yozish profillari: natija, PIN, savollar - "majority" (client default);
+# ro'yxatga olish, FSM, taymerlar kabi qayta tiklanadigan yozuvlar - w=1
+WRITE_CRITICAL = WriteConcern(w="majority")
+WRITE_FAST = WriteConcern(w=int(MONGO_W_FAST) if MONGO_W_FAST.isdigit() else MONGO_W_FAST)
+
+questions_col = db.get_collection("questions", write_concern=WRITE_CRITICAL)
+results_col = db.get_collection("results", write_concern=WRITE_CRITICAL)
+pins_col = db.get_collection("pins", write_concern=WRITE_CRITICAL)
+users_col = db.get_collection("users", write_concern=WRITE_FAST)
+images_col = db.get_collection("images", write_concern=WRITE_CRITICAL)
+pin_batches_col = db.get_collection("pin_batches", write_concern=WRITE_CRITICAL)
+test_forms_col = db.get_collection("test_forms", write_concern=WRITE_CRITICAL)
+counters_col = db.get_collection("counters", write_concern=WRITE_CRITICAL)
+topics_col = db.get_collection("topics", write_concern=WRITE_CRITICAL)
+dashboards_col = db.get_collection("dashboards", write_concern=WRITE_FAST)
+artifacts_col = db.get_collection("artifacts", write_concern=WRITE_FAST)
+fsm_col = db.get_collection("fsm_states", write_concern=WRITE_FAST)
+timers_col = db.get_collection("test_timers", write_concern=WRITE_FAST)
+import_jobs_col = db.get_collection("import_jobs", write_concern=WRITE_CRITICAL)
+import_staging_col = db.get_collection("import_staging", write_concern=WRITE_CRITICAL)
+
+# Import tugamaguncha yangi savollar shu belgi bilan yoziladi va testlarga berilmaydi
+VISIBLE = {"pending_job": {"$exists": False}}
+
+# ================= INDEXES =================
+# (kolleksiya, kalitlar, parametrlar) - har biri quyidagi so'rov shakllaridan biriga xizmat qiladi
+INDEXES = [
+    (questions_col, [("grade", 1), ("topic", 1)], {}),
+    (questions_col, [("pending_job", 1)], {"sparse": True}),  # commit: yashirin yangi savollarni topish
+    (results_col, [("user_id", 1), ("completed_at", -1)], {}),
+    (results_col, [("completed_at", 1)], {}),
+    (results_col, [("pin", 1), ("completed_at", -1)], {}),
+    (results_col, [("score", -1)], {}),
+    (results_col, [("batch_id", 1)], {}),
+    (pins_col, [("pin", 1)], {"unique": True}),
+    (pins_col, [("expires_at", 1)], {}),
+    (pins_col, [("batch_id", 1), ("number", 1)], {}),
+    (pin_batches_col, [("batch_id", 1)], {"unique": True}),
+    (pin_batches_col, [("created_at", -1)], {}),
+    (pin_batches_col, [("batch_no", 1)], {"unique": True, "partialFilterExpression": {"batch_no": {"$exists": True}}}),
+    (topics_col, [("name", 1)], {"unique": True}),
+    (test_forms_col, [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    (images_col, [("hash", 1)], {"unique": True}),
+    (images_col, [("phash", 1), ("_id", 1)], {"sparse": True}),  # load_phash_index: rasm o'qilmaydi
+    (timers_col, [("shard", 1)], {}),
+    (timers_col, [("batch_id", 1)], {}),
+    (timers_col, [("shard", 1), ("force", 1)], {"partialFilterExpression": {"force": True}}),
+    (import_jobs_col, [("shard", 1), ("status", 1)], {}),
+    (dashboards_col, [("shard", 1), ("dirty", 1)], {}),
+    (dashboards_col, [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    (artifacts_col, [("created_at", 1)], {"expireAfterSeconds": 30 * 86400}),
+    (import_staging_col, [("job_id", 1), ("idx", 1)], {"unique": True}),
+]
+
+# (nom, kolleksiya, filter, sort) - handlerlardagi haqiqiy so'rovlar
+QUERY_SHAPES = [
+    ("test_name: savollar", questions_col, {"grade": 7, "topic": "x", **VISIBLE}, None),
+    ("upsert_questions: fingerprint", questions_col, {"fingerprint": "x"}, None),
+    ("commit_import_job: yashirin savollar", questions_col, {"pending_job": "x"}, None),
+    ("results_pin_entered: PIN", results_col, {"pin": "x"}, [("completed_at", -1)]),
+    ("batch_totals: to'plam natijalari", results_col, {"batch_id": "x"}, None),
+    ("results_pin_entered: today/week", results_col, {"completed_at": {"$gte": datetime(2000, 1, 1)}}, [("completed_at", -1)]),
+    ("my_res: o'quvchi", results_col, {"user_id": 0}, [("completed_at", -1)]),
+    ("full_statistics: top", results_col, {}, [("score", -1)]),
+    ("test_pin: PIN", pins_col, {"pin": "x", "active": True, "expires_at": {"$gt": datetime(2000, 1, 1)}}, None),
+    ("pin_batch: PIN'lar", pins_col, {"batch_id": "x"}, [("number", 1)]),
+    ("pin_list: ishlatilgan", pins_col, {"batch_id": "x", "used_count": {"$gt": 0}}, None),
+    ("pin_batch: to'plam", pin_batches_col, {"batch_no": 0}, None),
+    ("pin_list: oxirgilar", pin_batches_col, {}, [("created_at", -1)]),
+    ("save_image: hash", images_col, {"hash": "x"}, None),
+    ("load_timers: shard", timers_col, {"shard": 0}, None),
+    ("resume_import_jobs: shard", import_jobs_col, {"shard": 0, "status": {"$in": ["parsing"]}}, None),
+    ("dashboard_loop: shard", dashboards_col, {"shard": 0, "dirty": True}, None),
+    ("commit_import_job: staging", import_staging_col, {"job_id": "x"}, [("idx", 1)]),
+]
+
+async def ensure_indexes():
+    await asyncio.gather(*(col.create_index(keys, **options) for col, keys, options in INDEXES))
+
+def _plan_stages(plan: dict) -> List[str]:
+    stages = [plan.get("stage", "?")]
+    for child in ("inputStage", "queryPlan"):
+        if child in plan:
+            stages += _plan_stages(plan[child])
+    for sub in plan.get("inputStages", []):
+        stages += _plan_stages(sub)
+    return stages
+
+async def index_report() -> List[tuple]:
+    """Har bir so'rov shakli uchun explain() - COLLSCAN va xotiradagi SORT ni topish"""
+    report = []
+    for name, col, query, sort in QUERY_SHAPES:
+        cursor = col.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            plan = (await cursor.limit(1).explain())["queryPlanner"]["winningPlan"]
+            stages = _plan_stages(plan)
+        except Exception as e:
+            report.append((name, col.name, [f"xato: {e}"], True))
+            continue
+        problem = "COLLSCAN" in stages or "SORT" in stages
+        report.append((name, col.name, stages, problem))
+    return report
+
+async def log_index_report():
+    for name, col_name, stages, problem in await index_report():
+        if problem:
+            log.warning("Index yo'q: %s (%s) -> %s", name, col_name, " > ".join(stages))
+        else:
+            log.info("Index OK: %s (%s) -> %s", name, col_name, " > ".join(stages))
+
+# ================= FSM STORAGE =================
+class MongoStorage(BaseStorage):
+    """FSM holatini MongoDB da saqlash - bir nechta worker uchun umumiy"""
+
+    def __init__(self, collection):
+        self.col = collection
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self.col.update_one({"_id": self.key_builder.build(key)}, {"$set": {"state": value}}, upsert=True)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        doc = await self.col.find_one({"_id": self.key_builder.build(key)}, {"state": 1})
+        return doc.get("state") if doc else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self.col.update_one({"_id": self.key_builder.build(key)}, {"$set": {"data": data}}, upsert=True)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        doc = await self.col.find_one({"_id": self.key_builder.build(key)}, {"data": 1})
+        return dict(doc.get("data") or {}) if doc else {}
+
+    async def close(self) -> None:
+        pass
 
 # ================= STATES =================
 class AdminStates(StatesGroup):
@@ -86,6 +541,7 @@ class AdminStates(StatesGroup):
     delete_confirm = State()  # YANGI
     delete_by_grade = State()  # YANGI
     delete_by_topic = State()  # YANGI
+    waiting_backup = State()
 
 class StudentStates(StatesGroup):
     waiting_pin = State()
@@ -97,10 +553,197 @@ class TeacherStates(StatesGroup):
     waiting_pin_for_report = State()
     selecting_report_type = State()  # YANGI
 # ================= HELPERS =================
-def generate_pin() -> str:
-    return ''.join(random.choices(string.digits, k=8))
+# PIN = Feistel(hisoblagich): [0, 10^8) ustida maxfiy kalitli o'zaro bir qiymatli almashtirish.
+# Hisoblagich takrorlanmaydi -> PIN'lar ham takrorlanmaydi; kalitsiz keyingi PIN'ni topib bo'lmaydi.
+PIN_SPACE = 10 ** 8
+PIN_HALF = 10 ** 4
+PIN_ROUNDS = 8
+
+class PinPermutation:
+    def __init__(self, key: bytes):
+        self.key = key
+
+    def _round(self, i: int, half: int) -> int:
+        digest = hmac.new(self.key, f"{i}:{half}".encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], "big") % PIN_HALF
+
+    def encrypt(self, n: int) -> int:
+        left, right = divmod(n, PIN_HALF)
+        for i in range(PIN_ROUNDS):
+            left, right = right, (left + self._round(i, right)) % PIN_HALF
+        return left * PIN_HALF + right
+
+    def decrypt(self, n: int) -> int:
+        left, right = divmod(n, PIN_HALF)
+        for i in reversed(range(PIN_ROUNDS)):
+            left, right = (right - self._round(i, left)) % PIN_HALF, left
+        return left * PIN_HALF + right
+
+pin_permutation: Optional[PinPermutation] = None
+
+async def load_pin_permutation() -> PinPermutation:
+    """Kalit bir marta (secrets) yaratiladi va bazada saqlanadi - barcha worker'lar bir xil kalitda"""
+    global pin_permutation
+    if pin_permutation is None:
+        update = {"$setOnInsert": {"key": secrets.token_hex(32), "next": 0}}
+        try:
+            doc = await counters_col.find_one_and_update({"_id": "pin"}, update, upsert=True, return_document=True)
+        except DuplicateKeyError:  # boshqa worker bir vaqtda yaratdi
+            doc = await counters_col.find_one({"_id": "pin"})
+        pin_permutation = PinPermutation(bytes.fromhex(doc["key"]))
+    return pin_permutation
+
+class PinCache:
+    """PIN qidiruv keshi: topilganlar (qisqa TTL), topilmaganlar (manfiy kesh) va
+    har bir foydalanuvchi uchun noto'g'ri urinishlar cheklovi. Har bir worker'da alohida -
+    o'quvchi doim bitta worker'da, boshqa worker'lardagi eski yozuv TTL bilan tugaydi"""
+
+    def __init__(self, ttl: float, negative_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.found: "OrderedDict[str, tuple]" = OrderedDict()  # pin -> (muddat, hujjat)
+        self.missing: "OrderedDict[str, float]" = OrderedDict()  # pin -> muddat
+        self.failures: Dict[int, list] = {}  # user_id -> noto'g'ri urinish vaqtlari
+        self.stats = {"hit": 0, "negative": 0, "miss": 0, "throttled": 0}
+
+    def _count(self, result: str):
+        self.stats[result] += 1
+        metrics.inc("pin_cache_total", result=result)
+
+    def get(self, pin: str):
+        """Hujjat, False (ma'lum - yo'q) yoki None (bazadan so'rash kerak)"""
+        now = time.monotonic()
+        entry = self.found.get(pin)
+        if entry and entry[0] > now:
+            if entry[1]['expires_at'] > datetime.now():
+                self._count("hit")
+                return entry[1]
+            self.found.pop(pin, None)
+        expires = self.missing.get(pin)
+        if expires and expires > now:
+            self._count("negative")
+            return False
+        self._count("miss")
+        return None
+
+    def put(self, pin: str, doc: Optional[dict]):
+        now = time.monotonic()
+        if doc:
+            self.missing.pop(pin, None)
+            self.found[pin] = (now + self.ttl, doc)
+            self.found.move_to_end(pin)
+            if len(self.found) > self.max_size:
+                self.found.popitem(last=False)
+        else:
+            self.missing[pin] = now + self.negative_ttl
+            self.missing.move_to_end(pin)
+            if len(self.missing) > self.max_size:
+                self.missing.popitem(last=False)
+
+    def invalidate(self, pin: str):
+        self.found.pop(pin, None)
+        self.missing.pop(pin, None)
+
+    def throttled(self, user_id: int) -> int:
+        """Cheklov tugashiga qolgan soniyalar (0 - cheklanmagan)"""
+        now = time.monotonic()
+        recent = [t for t in self.failures.get(user_id, []) if t > now - PIN_ATTEMPT_WINDOW]
+        if recent:
+            self.failures[user_id] = recent
+        else:
+            self.failures.pop(user_id, None)
+        if len(recent) >= PIN_ATTEMPTS:
+            self._count("throttled")
+            return int(recent[0] + PIN_ATTEMPT_WINDOW - now) + 1
+        return 0
+
+    def fail(self, user_id: int):
+        self.failures.setdefault(user_id, []).append(time.monotonic())
+        if len(self.failures) > self.max_size:
+            self.failures.pop(next(iter(self.failures)))
+
+    def summary(self) -> str:
+        return (f"🔑 PIN kesh: hit {self.stats['hit']}, manfiy {self.stats['negative']}, "
+                f"miss {self.stats['miss']}, cheklangan {self.stats['throttled']} | "
+                f"{len(self.found)}/{len(self.missing)} ta")
 
+pin_cache = PinCache(PIN_CACHE_TTL, PIN_NEGATIVE_TTL, PIN_CACHE_SIZE)
+
+async def next_id(name: str) -> int:
+    """counters kolleksiyasidan navbatdagi butun son (1, 2, 3, ...)"""
+    doc = await counters_col.find_one_and_update({"_id": name}, {"$inc": {"next": 1}}, upsert=True, return_document=True)
+    return doc["next"]
+
+async def assign_batch_no(batch: dict) -> int:
+    """Raqamsiz eski PIN to'plamiga batch_no - faqat hali yo'q bo'lsa yoziladi, g'olib qiymat qaytadi"""
+    await pin_batches_col.update_one({"_id": batch["_id"], "batch_no": {"$exists": False}},
+                                     {"$set": {"batch_no": await next_id("batch")}})
+    doc = await pin_batches_col.find_one({"_id": batch["_id"]}, {"batch_no": 1})
+    return doc["batch_no"]
+
+async def backfill_batch_numbers():
+    """Startup'da bir marta: eski to'plamlarga raqam (callback_data'da batch_no ishlatiladi)"""
+    async for batch in pin_batches_col.find({"batch_no": {"$exists": False}}, {"_id": 1}):
+        await assign_batch_no(batch)
+
+class TopicRegistry:
+    """Mavzu nomi <-> qisqa butun son: callback_data 64 baytga sig'adi, qidiruv - dict bo'yicha.
+    Raqamlar topics kolleksiyasida saqlanadi (barcha worker'larda bir xil)"""
+
+    def __init__(self):
+        self.by_id: Dict[int, str] = {}
+        self.by_name: Dict[str, int] = {}
+        self.loaded = False
+
+    def _remember(self, topic_id: int, name: str):
+        self.by_id[topic_id] = name
+        self.by_name[name] = topic_id
+
+    async def load(self):
+        async for doc in topics_col.find():
+            self._remember(doc["_id"], doc["name"])
+        self.loaded = True
+
+    async def id_for(self, name: str) -> int:
+        if not self.loaded:
+            await self.load()
+        topic_id = self.by_name.get(name)
+        if topic_id is None:
+            doc = await topics_col.find_one({"name": name})
+            if doc is None:
+                try:
+                    doc = {"_id": await next_id("topic"), "name": name}
+                    await topics_col.insert_one(doc)
+                except DuplicateKeyError:  # boshqa worker shu nomni hozirgina qo'shdi
+                    doc = await topics_col.find_one({"name": name})
+            topic_id = doc["_id"]
+            self._remember(topic_id, name)
+        return topic_id
+
+    async def name_for(self, topic_id: int) -> Optional[str]:
+        name = self.by_id.get(topic_id)
+        if name is None:
+            doc = await topics_col.find_one({"_id": topic_id})
+            if doc:
+                name = doc["name"]
+                self._remember(topic_id, name)
+        return name
+
+topic_registry = TopicRegistry()
+
+async def allocate_pins(count: int) -> List[str]:
+    """Hisoblagichdan `count` ta qiymatni bitta $inc bilan band qilish"""
+    perm = await load_pin_permutation()
+    doc = await counters_col.find_one_and_update({"_id": "pin"}, {"$inc": {"next": count}}, return_document=True)
+    end = doc["next"]
+    if end > PIN_SPACE:
+        raise RuntimeError("PIN maydoni tugadi")
+    return [f"{perm.encrypt(n):08d}" for n in range(end - count, end)]
+
+@timed("cpu_seconds", func="compress_image")
 def compress_image(image_data: bytes) -> bytes:
+    from PIL import Image as PILImage
     try:
         img = PILImage.open(io.BytesIO(image_data))
         if max(img.size) > MAX_IMAGE_DIMENSION:
@@ -118,45 +761,435 @@ def compress_image(image_data: bytes) -> bytes:
             img.save(output, format='JPEG', quality=quality, optimize=True)
         return output.getvalue()
     except Exception as e:
-        print(f"Image compression error: {e}")
+        log.warning("Image compression error: %s", e)
         return image_data
 
+class ImageCache:
+    """Rasm keshi: xotiradagi LRU (bayt bo'yicha cheklangan) + lokal disk (hash bo'yicha)"""
+
+    def __init__(self, max_bytes: int, disk_dir: str = ""):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.lru: "OrderedDict[str, bytes]" = OrderedDict()  # image_id -> bytes
+        self.size = 0
+        self.hashes: Dict[str, str] = {}  # image_id -> hash (disk kaliti)
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, image_id: str) -> Optional[bytes]:
+        data = self.lru.get(image_id)
+        if data is not None:
+            self.lru.move_to_end(image_id)
+            self._hit("memory")
+            return data
+        img_hash = self.hashes.get(image_id)
+        if img_hash and self.disk_dir:
+            data = self._read_disk(img_hash)
+            if data is not None:
+                self._remember(image_id, data)
+                self._hit("disk")
+                return data
+        self.misses += 1
+        metrics.inc("image_cache_total", result="miss")
+        return None
+
+    def put(self, image_id: str, img_hash: str, data: bytes):
+        self.hashes[image_id] = img_hash
+        self._remember(image_id, data)
+        if self.disk_dir:
+            self._write_disk(img_hash, data)
+
+    def _hit(self, tier: str):
+        self.hits[tier] += 1
+        metrics.inc("image_cache_total", result="hit", tier=tier)
+
+    def _remember(self, image_id: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        old = self.lru.pop(image_id, None)
+        if old is not None:
+            self.size -= len(old)
+        self.lru[image_id] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.lru.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _path(self, img_hash: str) -> str:
+        return os.path.join(self.disk_dir, img_hash[:2], f"{img_hash}.jpg")
+
+    def _read_disk(self, img_hash: str) -> Optional[bytes]:
+        try:
+            with open(self._path(img_hash), "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return mm[:]
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, img_hash: str, data: bytes):
+        path = self._path(img_hash)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("Disk kesh yozish xatosi: %s", e)
+
+    def summary(self) -> str:
+        total = sum(self.hits.values()) + self.misses
+        rate = sum(self.hits.values()) / total * 100 if total else 0
+        return (f"🖼 Rasm kesh: {rate:.0f}% hit (xotira {self.hits['memory']}, disk {self.hits['disk']}, "
+                f"miss {self.misses}) | {self.size // 1024} KB / {len(self.lru)} ta")
+
+image_cache = ImageCache(IMAGE_CACHE_BYTES, IMAGE_CACHE_DIR)
+
+async def warm_image_hashes():
+    """Restartdan keyin disk keshdan foydalanish uchun image_id -> hash xaritasi (faqat hash maydoni)"""
+    async for img in images_col.find({}, {"hash": 1}):
+        image_cache.hashes[str(img["_id"])] = img["hash"]
+
+@timed("cpu_seconds", func="dhash")
+def dhash(image_data: bytes) -> int:
+    """64 bitli perceptual hash (dHash) - o'lchami/sifati boshqa bir xil rasm uchun yaqin qiymat"""
+    from PIL import Image as PILImage
+    img = PILImage.open(io.BytesIO(image_data)).convert("L").resize((9, 8), PILImage.LANCZOS)
+    px = list(img.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return value
+
+def same_picture(a: bytes, b: bytes) -> bool:
+    """phash nomzodini tasdiqlash: tomonlar nisbati bir xil va 32x32 kulrang nusxalar deyarli teng.
+    Joylashuvi o'xshash, lekin boshqa chizma hash bo'yicha yaqin chiqishi mumkin"""
+    from PIL import Image as PILImage, ImageChops
+    img_a = PILImage.open(io.BytesIO(a))
+    img_b = PILImage.open(io.BytesIO(b))
+    if abs(img_a.width / img_a.height - img_b.width / img_b.height) > 0.01:
+        return False
+    small_a = img_a.convert("L").resize((32, 32), PILImage.LANCZOS)
+    small_b = img_b.convert("L").resize((32, 32), PILImage.LANCZOS)
+    diff = list(ImageChops.difference(small_a, small_b).getdata())
+    return sum(diff) / len(diff) <= 4 and max(diff) <= 64
+
+class BKTree:
+    """Hamming masofasi bo'yicha qidiruv daraxti: yaqin hashlarni butun ro'yxatni ko'rmasdan topadi"""
+
+    def __init__(self):
+        self.root = None  # [hash, image_id, {masofa: tugun}]
+        self.size = 0
+
+    def add(self, value: int, image_id: str):
+        if self.root is None:
+            self.root = [value, image_id, {}]
+            self.size += 1
+            return
+        node = self.root
+        while True:
+            d = bin(value ^ node[0]).count("1")
+            if d == 0:
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, image_id, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value: int, threshold: int) -> Optional[tuple]:
+        """Eng yaqin (masofa, image_id) yoki None"""
+        best = None
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = bin(value ^ node[0]).count("1")
+            if d <= threshold and (best is None or d < best[0]):
+                best = (d, node[1])
+            for dist, child in node[2].items():
+                if d - threshold <= dist <= d + threshold:
+                    stack.append(child)
+        return best
+
+phash_index = BKTree()
+phash_ready = False
+phash_lock = asyncio.Lock()
+
+async def load_phash_index():
+    """Indexni bir marta qurish - faqat saqlangan phash maydoni o'qiladi (rasm ma'lumoti emas)"""
+    global phash_ready
+    async with phash_lock:
+        if phash_ready:
+            return
+        async for img in images_col.find({"phash": {"$exists": True}}, {"phash": 1}):
+            phash_index.add(int(img["phash"], 16), str(img["_id"]))
+        phash_ready = True
+        log.info("phash index: %d ta rasm", phash_index.size)
+
+async def backfill_phashes():
+    """phash'siz eski rasmlar uchun hisoblab saqlash (startup'da fonda; yangilari save_image'da oladi)"""
+    done = 0
+    async for img in images_col.find({"phash": {"$exists": False}}, {"data": 1}):
+        try:
+            value = await asyncio.to_thread(dhash, base64.b64decode(img["data"]))
+        except Exception as e:
+            log.warning("phash hisoblanmadi (%s): %s", img["_id"], e)
+            continue
+        await images_col.update_one({"_id": img["_id"], "phash": {"$exists": False}},
+                                    {"$set": {"phash": f"{value:016x}"}})
+        if phash_ready:
+            phash_index.add(value, str(img["_id"]))
+        done += 1
+    if done:
+        log.info("phash hisoblandi: %d ta eski rasm", done)
+
 async def save_image(image_data: bytes) -> str:
     try:
         compressed = compress_image(image_data)
         img_hash = hashlib.md5(compressed).hexdigest()
-        existing = await images_col.find_one({"hash": img_hash})
+        existing = await images_col.find_one({"hash": img_hash}, {"_id": 1})
         if existing:
+            image_cache.hashes[str(existing["_id"])] = img_hash
             return str(existing["_id"])
-        result = await images_col.insert_one({
+        
+        # Bir xil diagramma boshqa o'lchamda - perceptual hash bo'yicha qayta ishlatish.
+        # phash doim saqlanadi: keyin PHASH_THRESHOLD yoqilsa index rasm ma'lumotisiz quriladi
+        phash = dhash(compressed)
+        if PHASH_THRESHOLD >= 0:
+            if not phash_ready:
+                await load_phash_index()
+            match = phash_index.search(phash, PHASH_THRESHOLD)
+            candidate = await get_image(match[1]) if match else None
+            if candidate and same_picture(compressed, candidate):
+                metrics.inc("image_dedup_total", kind="phash")
+                log.debug("phash takror: %s (masofa %d)", match[1], match[0])
+                return match[1]
+        
+        doc = {
             "hash": img_hash,
             "data": base64.b64encode(compressed).decode(),
-            "size": len(compressed)
-        })
-        return str(result.inserted_id)
-    except Exception as e:
-        print(f"Save image error: {e}")
+            "size": len(compressed),
+            "phash": f"{phash:016x}"
+        }
+        result = await images_col.insert_one(doc)
+        image_id = str(result.inserted_id)
+        image_cache.hashes[image_id] = img_hash
+        if phash_ready:
+            phash_index.add(phash, image_id)
+        return image_id
+    except Exception:
+        log.exception("Save image error")
         return None
 
 async def get_image(image_id: str) -> Optional[bytes]:
+    cached = image_cache.get(image_id)
+    if cached is not None:
+        return cached
     try:
         img = await images_col.find_one({"_id": ObjectId(image_id)})
         if img:
-            return base64.b64decode(img["data"])
+            data = base64.b64decode(img["data"])
+            image_cache.put(image_id, img["hash"], data)
+            return data
     except Exception as e:
-        print(f"Get image error: {e}")
+        log.warning("Get image error (%s): %s", image_id, e)
     return None
 
-async def parse_word_with_images(file_path: str) -> List[dict]:
-    """Word hujjatni rasmlar bilan parse qilish - YANGI VERSIYA"""
-    doc = Document(file_path)
+APOSTROPHES = str.maketrans({c: "'" for c in "‘’ʻʼ`´"})
+
+def normalize_text(text) -> str:
+    """Taqqoslash uchun: NFKC, kichik harf, apostrof turlari va bo'shliqlar bir xil"""
+    text = unicodedata.normalize("NFKC", str(text)).translate(APOSTROPHES).lower()
+    return " ".join(text.split())
+
+def question_fingerprint(q: dict, grade: int, topic: str) -> str:
+    """Savol kaliti: matn + variantlar + sinf + mavzu (javob/rasm/izoh o'zgarsa - yangilanadi)"""
+    key = [grade, normalize_text(topic), normalize_text(q['text']), [normalize_text(o) for o in q.get('options', [])]]
+    return hashlib.sha1(json.dumps(key, ensure_ascii=False).encode()).hexdigest()
+
+async def upsert_questions(questions: List[dict], grade: int, topic: str, difficulty: str, created_by: int,
+                           job_id: Optional[str] = None) -> dict:
+    """Fingerprint bo'yicha upsert: yangilari qo'shiladi, o'zgarganlari yangilanadi, bir xillari o'tkaziladi.
+    job_id berilsa - faqat yangilari, pending_job belgisi bilan (mavjud savollarga tegilmaydi)"""
+    by_fp = {}
+    for q in questions:
+        by_fp[question_fingerprint(q, grade, topic)] = q
+    
+    ops = []
+    for fp, q in by_fp.items():
+        content = {
+            'answer': q['answer'],
+            'images': q.get('images', []),
+            'type': q.get('type', 'choice'),
+            'explanation': q.get('explanation', '')
+        }
+        new_only = {
+            'fingerprint': fp,
+            'text': q['text'],
+            'options': q.get('options', []),
+            'grade': grade,
+            'topic': topic,
+            'created_at': datetime.now(),
+            'created_by': created_by
+        }
+        if difficulty == "Aralash":
+            new_only['difficulty'] = random.choice(["Bilish", "Qo'llash", "Mulohaza"])
+        else:
+            content['difficulty'] = difficulty
+        if job_id:
+            update = {"$setOnInsert": {**content, **new_only, "pending_job": job_id}}
+        else:
+            update = {"$set": content, "$setOnInsert": new_only}
+        ops.append(UpdateOne({"fingerprint": fp}, update, upsert=True))
+    
+    counts = {"new": 0, "updated": 0, "unchanged": len(questions) - len(by_fp)}
+    if ops:
+        result = await bulk_upsert_questions(ops)
+        counts["new"] = result.upserted_count
+        counts["updated"] = result.modified_count
+        counts["unchanged"] += result.matched_count - result.modified_count
+    return counts
+
+async def bulk_upsert_questions(ops: List[UpdateOne]):
+    """fingerprint unique: parallel yuklash xuddi shu savolni hozirgina qo'shgan bo'lsa (E11000),
+    qayta urinishda upsert mavjud hujjatga tushadi"""
+    try:
+        return await questions_col.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        return await questions_col.bulk_write(ops, ordered=False)
+
+async def backfill_fingerprints():
+    """Fingerprint'siz eski savollarga kalit yozish (qayta yuklashda takrorlanmasligi uchun)"""
+    ops = []
+    async for q in questions_col.find({"fingerprint": {"$exists": False}}, {"text": 1, "options": 1, "grade": 1, "topic": 1}):
+        ops.append(UpdateOne({"_id": q["_id"]}, {"$set": {"fingerprint": question_fingerprint(q, q['grade'], q['topic'])}}))
+        if len(ops) >= 500:
+            await questions_col.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await questions_col.bulk_write(ops, ordered=False)
+
+DUPLICATE_PIPELINE = [
+    {"$match": {"fingerprint": {"$exists": True}}},
+    {"$group": {"_id": "$fingerprint", "ids": {"$push": "$_id"}, "n": {"$sum": 1},
+                "text": {"$first": "$text"}, "grade": {"$first": "$grade"}, "topic": {"$first": "$topic"},
+                "answers": {"$addToSet": "$answer"}}},
+    {"$match": {"n": {"$gt": 1}}}
+]
+
+async def duplicate_groups() -> List[dict]:
+    """Bir xil fingerprint'li savollar guruhlari (admin birlashtirishdan oldin ko'radi)"""
+    return await questions_col.aggregate(DUPLICATE_PIPELINE).to_list(None)
+
+async def merge_duplicate_questions() -> int:
+    """Bir xil fingerprint'li savollardan eng yangisi qoladi (oxirgi yuklash - eng to'g'ri nusxa)"""
+    removed = 0
+    for group in await duplicate_groups():
+        keep = max(group["ids"])
+        result = await questions_col.delete_many({"_id": {"$in": [i for i in group["ids"] if i != keep]}})
+        removed += result.deleted_count
+    return removed
+
+async def prepare_fingerprints() -> bool:
+    """Unique fingerprint index - parallel yuklashlar takror yarata olmaydi.
+    Dublikatlar bo'lsa index oddiy qoladi, admin /duplicates orqali birlashtiradi"""
+    info = await questions_col.index_information()
+    if info.get("fingerprint_1", {}).get("unique"):
+        return True
+    await backfill_fingerprints()
+    if "fingerprint_1" in info:
+        await questions_col.drop_index("fingerprint_1")
+    try:
+        await questions_col.create_index([("fingerprint", 1)], unique=True,
+                                         partialFilterExpression={"fingerprint": {"$exists": True}})
+        return True
+    except DuplicateKeyError:
+        await questions_col.create_index([("fingerprint", 1)])
+        log.warning("Takroriy savollar bor - unique index yaratilmadi, /duplicates bilan birlashtiring")
+        return False
+
+def session_question(q: dict) -> dict:
+    """Sessiyada saqlanadigan savol ko'rinishi"""
+    return {
+        'id': str(q['_id']),
+        'text': q['text'],
+        'options': q.get('options', []),
+        'answer': q['answer'],
+        'type': q.get('type', 'choice'),
+        'images': q.get('images', [])
+    }
+
+async def build_test_forms(batch_id: str, grade: int, topic: str, count: int, expires_at: datetime) -> int:
+    """PIN to'plami uchun TEST_FORMS ta variant: savol tartibi + variantlar almashtirilishi.
+    Savol matnlari bir marta (bank), variantlar - [bank indeksi, [variantlar tartibi]] ro'yxati"""
+    if TEST_FORMS <= 0:
+        return 0
+    all_q = await questions_col.find(
+        {"grade": grade, "topic": topic, **VISIBLE},
+        {"text": 1, "options": 1, "answer": 1, "type": 1, "images": 1}
+    ).to_list(200)
+    if not all_q:
+        return 0
+    count = min(count, len(all_q))
+    
+    bank, bank_index, forms = [], {}, []
+    for _ in range(TEST_FORMS):
+        form = []
+        for q in random.sample(all_q, count):
+            if q['_id'] not in bank_index:
+                bank_index[q['_id']] = len(bank)
+                bank.append(session_question(q))
+            perm = []
+            if q.get('options') and isinstance(q.get('answer'), int):
+                perm = random.sample(range(len(q['options'])), len(q['options']))
+            form.append([bank_index[q['_id']], perm])
+        forms.append(form)
+    
+    await test_forms_col.replace_one(
+        {"_id": batch_id},
+        {"_id": batch_id, "bank": bank, "forms": forms, "created_at": datetime.now(), "expires_at": expires_at},
+        upsert=True
+    )
+    return len(forms)
+
+def form_questions(doc: dict) -> List[dict]:
+    """Tasodifiy variantni tanlash va sessiya savollarini yig'ish - bazaga murojaatsiz"""
     questions = []
+    for i, perm in random.choice(doc['forms']):
+        q = dict(doc['bank'][i])
+        if perm:
+            q['options'] = [q['options'][p] for p in perm]
+            q['answer'] = perm.index(q['answer'])
+        questions.append(q)
+    return questions
+
+def ingest_report(counts: dict) -> str:
+    return (f"🆕 Yangi: {counts['new']}\n"
+            f"✏️ Yangilangan: {counts['updated']}\n"
+            f"♻️ O'zgarmagan: {counts['unchanged']}")
+
+async def iter_word_questions(file_path: str, skip: int = 0):
+    """Word hujjatdan savollarni ketma-ket chiqarish: (paragraf, jami paragraflar, savol).
+    Birinchi `skip` ta savol rasmlari qayta saqlanmaydi (import davom ettirilganda)"""
+    from docx import Document
+    with metrics.timer("cpu_seconds", func="docx_load"):
+        doc = Document(file_path)
+    paragraphs = doc.paragraphs  # har murojaatda qayta quriladi - bir marta olamiz
+    emitted = 0
     current_q = None
     
     # Barcha rasmlarni paragraf indeksi bilan olish
     para_images = {}  # {para_index: [image_data, ...]}
     
-    for para_idx, para in enumerate(doc.paragraphs):
+    for para_idx, para in enumerate(paragraphs):
         images = []
         try:
             for run in para.runs:
@@ -184,16 +1217,16 @@ async def parse_word_with_images(file_path: str) -> List[dict]:
                             except:
                                 pass
         except Exception as e:
-            print(f"Para {para_idx} rasm xatosi: {e}")
+            log.warning("Para %d rasm xatosi: %s", para_idx, e)
         
         if images:
             para_images[para_idx] = images
-            print(f"✓ Para {para_idx}: {len(images)} ta rasm")
+            log.debug("Para %d: %d ta rasm", para_idx, len(images), extra={"sampled": True})
     
-    print(f"Jami {sum(len(imgs) for imgs in para_images.values())} ta rasm topildi")
+    log.info("Word: %d ta rasm topildi", sum(len(imgs) for imgs in para_images.values()))
     
     # Paragraflarni qayta ishlash
-    for para_idx, para in enumerate(doc.paragraphs):
+    for para_idx, para in enumerate(paragraphs):
         text = para.text.strip()
         
         if not text:
@@ -202,7 +1235,9 @@ async def parse_word_with_images(file_path: str) -> List[dict]:
         # Yangi savol
         if re.match(r'^\d+[\.\)]\s*', text):
             if current_q and current_q.get('text'):
-                questions.append(current_q)
+                current_q.pop('para_index', None)
+                yield para_idx, len(paragraphs), current_q
+                emitted += 1
             
             q_text = re.sub(r'^\d+[\.\)]\s*', '', text)
             current_q = {
@@ -215,19 +1250,22 @@ async def parse_word_with_images(file_path: str) -> List[dict]:
                 'para_index': para_idx
             }
             
+            if emitted < skip:
+                continue
+            
             # Shu paragrafda rasm bormi
             if para_idx in para_images:
                 for img_data in para_images[para_idx]:
                     img_id = await save_image(img_data)
                     if img_id:
                         current_q['images'].append(img_id)
-                        print(f"  → Savol {len(questions)+1} ga rasm: {img_id}")
+                        log.debug("Savol %d ga rasm: %s", emitted + 1, img_id, extra={"sampled": True})
             
             # Keyingi paragrafda rasm bormi tekshirish (savol keyin rasm)
             next_idx = para_idx + 1
             if next_idx in para_images:
                 # Keyingi paragraf matn bo'sh yoki variant bo'lsa, rasm savolga tegishli
-                next_para = doc.paragraphs[next_idx] if next_idx < len(doc.paragraphs) else None
+                next_para = paragraphs[next_idx] if next_idx < len(paragraphs) else None
                 if next_para:
                     next_text = next_para.text.strip()
                     # Agar keyingi qator variant emas yoki bo'sh bo'lsa, rasm savolga tegishli
@@ -236,7 +1274,7 @@ async def parse_word_with_images(file_path: str) -> List[dict]:
                             img_id = await save_image(img_data)
                             if img_id and img_id not in current_q['images']:
                                 current_q['images'].append(img_id)
-                                print(f"  → Savol {len(questions)+1} ga rasm (keyingi): {img_id}")
+                                log.debug("Savol %d ga rasm (keyingi): %s", emitted + 1, img_id, extra={"sampled": True})
         
         # Variant
         elif re.match(r'^[A-Da-d][\.\)]\s*', text) and current_q:
@@ -262,19 +1300,30 @@ async def parse_word_with_images(file_path: str) -> List[dict]:
     
     # Oxirgi savol
     if current_q and current_q.get('text'):
-        questions.append(current_q)
-    
-    # para_index ni o'chirish
-    for q in questions:
-        q.pop('para_index', None)
+        current_q.pop('para_index', None)
+        yield len(paragraphs), len(paragraphs), current_q
+
+async def parse_word_with_images(file_path: str) -> List[dict]:
+    """Word hujjatni rasmlar bilan parse qilish - YANGI VERSIYA"""
+    questions = [q async for _, _, q in iter_word_questions(file_path)]
     
-    print(f"\n✅ {len(questions)} ta savol parse qilindi")
-    for i, q in enumerate(questions, 1):
-        print(f"  {i}. {q['text'][:50]}... | {len(q.get('images', []))} rasm | {len(q.get('options', []))} variant")
+    log.info("Word: %d ta savol parse qilindi", len(questions))
+    if log.isEnabledFor(logging.DEBUG):
+        for i, q in enumerate(questions, 1):
+            log.debug("%d. %s... | %d rasm | %d variant", i, q['text'][:50], len(q.get('images', [])),
+                      len(q.get('options', [])), extra={"sampled": True})
     
     return questions
 
-def generate_pins_pdf(pins_data: List[dict], batch_info: dict) -> bytes:
+@timed("cpu_seconds", func="generate_pins_pdf")
+def generate_pins_pdf(pins_data: List[dict], batch_info: dict, bot_username: Optional[str] = None,
+                      part: Optional[str] = None) -> bytes:
+    """PIN jadvali; bot_username berilsa har bir PIN yonida t.me/<bot>?start=<pin> QR kodi"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import cm
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm)
     elements = []
@@ -295,17 +1344,65 @@ def generate_pins_pdf(pins_data: List[dict], batch_info: dict) -> bytes:
     attempts_text = "Cheksiz" if (multi_use and max_attempts >= 999) else f"{max_attempts} marta"
     elements.append(Paragraph(f"<b>Urinishlar:</b> {attempts_text}", info_style))
     elements.append(Paragraph(f"<b>Yaratildi:</b> {datetime.now().strftime('%d.%m.%Y %H:%M')}", info_style))
+    if part:
+        elements.append(Paragraph(f"<b>Qism:</b> {part}", info_style))
     elements.append(Spacer(1, 0.5*cm))
     
-    table_data = [["№", "PIN KOD", "O'QUVCHI", "HOLAT"]]
-    for i, pin in enumerate(pins_data, 1):
-        table_data.append([str(i), pin['pin'], "", "Faol"])
+    if bot_username:
+        from reportlab.graphics.barcode import qrencoder
+        from reportlab.platypus import Flowable
+        
+        class FixedMaskQR(qrencoder.QRCode):
+            # 8 ta niqobni baholash kodlash vaqtining ~85% i; 0-niqob standart bo'yicha to'g'ri
+            def getBestMaskPattern(self):
+                return 0
+        
+        class QrFlowable(Flowable):
+            """QR modullari bitta PDF path sifatida - har modul uchun alohida shakl yaratilmaydi"""
+            
+            def __init__(self, data: str, size: float):
+                super().__init__()
+                code = FixedMaskQR(None, qrencoder.QRErrorCorrectLevel.M)
+                code.addData(data)
+                code.make()
+                self.modules = code.modules
+                self.width = self.height = size
+            
+            def draw(self):
+                n = len(self.modules)
+                box = self.width / n
+                path = self.canv.beginPath()
+                for r, row in enumerate(self.modules):
+                    c = 0
+                    while c < n:
+                        if row[c]:
+                            start = c
+                            while c < n and row[c]:
+                                c += 1
+                            path.rect(start * box, (n - r - 1) * box, (c - start) * box, box)
+                        else:
+                            c += 1
+                self.canv.drawPath(path, stroke=0, fill=1)
+        
+        def qr(pin: str):
+            return QrFlowable(f"https://t.me/{bot_username}?start={pin}", 2.2*cm)
+        
+        table_data = [["№", "PIN KOD", "QR", "O'QUVCHI", "HOLAT"]]
+        table_data += [[str(pin.get('number', i)), pin['pin'], qr(pin['pin']), "", "Faol"]
+                       for i, pin in enumerate(pins_data, 1)]
+        col_widths = [1.2*cm, 3.3*cm, 2.8*cm, 6.2*cm, 3*cm]
+    else:
+        table_data = [["№", "PIN KOD", "O'QUVCHI", "HOLAT"]]
+        for i, pin in enumerate(pins_data, 1):
+            table_data.append([str(pin.get('number', i)), pin['pin'], "", "Faol"])
+        col_widths = [1.5*cm, 4*cm, 8*cm, 3*cm]
     
-    table = Table(table_data, colWidths=[1.5*cm, 4*cm, 8*cm, 3*cm])
+    table = Table(table_data, colWidths=col_widths, repeatRows=1)
     table.setStyle(TableStyle([
         ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4CAF50')),
         ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
         ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
         ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
         ('FONTSIZE', (0, 0), (-1, -1), 10),
         ('GRID', (0, 0), (-1, -1), 1, colors.black),
@@ -319,9 +1416,13 @@ def generate_pins_pdf(pins_data: List[dict], batch_info: dict) -> bytes:
     buffer.seek(0)
     return buffer.read()
 
-def generate_pins_json(pins_data: List[dict], batch_info: dict) -> str:
-    export_data = {
-        "batch_info": {
+class PinsJsonWriter:
+    """PIN'lar JSON fayli - butun ro'yxat xotirada yig'ilmaydi, bo'laklab yoziladi"""
+
+    def __init__(self, path: str, batch_info: dict):
+        self.f = open(path, "w", encoding="utf-8")
+        self.count = 0
+        header = {
             "grade": batch_info['grade'],
             "topic": batch_info['topic'],
             "question_count": batch_info['question_count'],
@@ -329,17 +1430,987 @@ def generate_pins_json(pins_data: List[dict], batch_info: dict) -> str:
             "multi_use": batch_info.get('multi_use', False),
             "max_attempts": batch_info.get('max_attempts', 1),
             "created_at": datetime.now().isoformat(),
-            "total_pins": len(pins_data)
-        },
-        "pins": [{"number": i, "pin": pin['pin'], "student": "", "status": "active"} 
-                 for i, pin in enumerate(pins_data, 1)]
-    }
-    return json.dumps(export_data, ensure_ascii=False, indent=2)
+            "total_pins": batch_info['pin_count']
+        }
+        self.f.write('{\n  "batch_info": ' + json.dumps(header, ensure_ascii=False) + ',\n  "pins": [')
+
+    def write(self, pins: List[dict]):
+        for pin in pins:
+            self.count += 1
+            item = {"number": pin.get('number', self.count), "pin": pin['pin'], "student": "", "status": "active"}
+            self.f.write((",\n    " if self.count > 1 else "\n    ") + json.dumps(item, ensure_ascii=False))
+
+    def close(self):
+        self.f.write("\n  ]\n}\n")
+        self.f.close()
+
+def artifact_key(kind: str, *parts) -> str:
+    """Fayl kaliti: turi + so'rov + ma'lumot belgisi (oxirgi completed_at, soni) - ma'lumot
+    o'zgarsa kalit ham o'zgaradi, eskisi LRU'dan o'z-o'zidan chiqib ketadi"""
+    raw = json.dumps([kind, *parts], default=str, ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+class ArtifactCache:
+    """Tayyor PDF/JSON baytlari (xotira LRU + diskda ARTIFACT_DISK_BYTES gacha) va Telegram
+    file_id'lari (artifacts kolleksiyasida - barcha worker'lar uchun): yuborilgan fayl qayta
+    yuklanmaydi, file_id bilan jo'natiladi"""
+
+    def __init__(self, max_bytes: int, disk_dir: str = "", disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.lru: "OrderedDict[str, bytes]" = OrderedDict()
+        self.size = 0
+        self.disk_size = 0  # oxirgi skanerlashdagi hajm (katalog barcha worker'larga umumiy)
+        self.file_ids: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = {"file_id": 0, "memory": 0, "disk": 0}
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan()
+
+    def _hit(self, tier: str):
+        self.hits[tier] += 1
+        metrics.inc("artifact_cache_total", result="hit", tier=tier)
+
+    async def file_id(self, key: str) -> Optional[str]:
+        file_id = self.file_ids.get(key)
+        if file_id is None:
+            doc = await artifacts_col.find_one({"_id": key})
+            if doc is None:
+                return None
+            file_id = doc["file_id"]
+            self._remember_file_id(key, file_id)
+        self._hit("file_id")
+        return file_id
+
+    def _remember_file_id(self, key: str, file_id: str):
+        self.file_ids[key] = file_id
+        self.file_ids.move_to_end(key)
+        while len(self.file_ids) > 10000:
+            self.file_ids.popitem(last=False)
+
+    async def save_file_id(self, key: str, file_id: str):
+        self._remember_file_id(key, file_id)
+        await artifacts_col.replace_one({"_id": key}, {"_id": key, "file_id": file_id, "created_at": datetime.now()},
+                                        upsert=True)
+
+    async def forget_file_id(self, key: str):
+        self.file_ids.pop(key, None)
+        await artifacts_col.delete_one({"_id": key})
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self.lru.get(key)
+        if data is not None:
+            self.lru.move_to_end(key)
+            self._hit("memory")
+            return data
+        if self.disk_dir:
+            path = os.path.join(self.disk_dir, key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data is not None:
+                try:
+                    os.utime(path)  # LRU tartibi - mtime bo'yicha
+                except OSError:
+                    pass
+                self._remember(key, data)
+                self._hit("disk")
+                return data
+        self.misses += 1
+        metrics.inc("artifact_cache_total", result="miss")
+        return None
+
+    def put(self, key: str, data: bytes):
+        self._remember(key, data)
+        if self.disk_dir and len(data) <= self.disk_bytes:
+            self._write_disk(key, data)
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        old = self.lru.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.lru[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.lru.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _write_disk(self, key: str, data: bytes):
+        path = os.path.join(self.disk_dir, key)
+        try:
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("Disk kesh yozish xatosi: %s", e)
+            return
+        self._evict()
+
+    def _scan(self) -> List[tuple]:
+        """(mtime, hajm, yo'l) eskisidan yangisiga - boshqa worker'lar yozganlari ham hisobga olinadi"""
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            try:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            except OSError:
+                continue  # boshqa worker hozirgina o'chirdi
+        entries.sort()
+        self.disk_size = sum(size for _, size, _ in entries)
+        return entries
+
+    def _evict(self):
+        """Har yozishdan keyin katalog qayta skanerlanadi - byudjet worker'lar soniga ko'paymaydi"""
+        entries = self._scan()
+        for _, size, path in entries:
+            if self.disk_size <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.disk_size -= size
+
+    def summary(self) -> str:
+        total = sum(self.hits.values()) + self.misses
+        rate = sum(self.hits.values()) / total * 100 if total else 0
+        return (f"📦 Fayl kesh: {rate:.0f}% hit (file_id {self.hits['file_id']}, xotira {self.hits['memory']}, "
+                f"disk {self.hits['disk']}, miss {self.misses}) | {self.size // 1024} KB / {len(self.lru)} ta"
+                + (f" | disk {self.disk_size // 1024} KB" if self.disk_dir else ""))
+
+artifact_cache = ArtifactCache(ARTIFACT_CACHE_BYTES, ARTIFACT_CACHE_DIR, ARTIFACT_DISK_BYTES)
+
+async def answer_document(msg: Message, document, caption: str) -> Message:
+    """Ketma-ket ko'p fayl yuborishda Telegram flood limiti - retry_after kutib qayta urinish"""
+    while True:
+        try:
+            return await msg.answer_document(document, caption=caption)
+        except TelegramRetryAfter as e:
+            log.warning("Flood limit: %s s kutilmoqda", e.retry_after)
+            await asyncio.sleep(e.retry_after)
+
+async def send_artifact(msg: Message, key: str, build, filename: str, caption: str):
+    """Avval file_id, keyin keshdagi baytlar; bo'lmasa `build()` (bytes qaytaruvchi korutina)"""
+    file_id = await artifact_cache.file_id(key)
+    if file_id:
+        try:
+            await answer_document(msg, file_id, caption)
+            return
+        except TelegramBadRequest:
+            await artifact_cache.forget_file_id(key)
+    data = artifact_cache.get(key)
+    if data is None:
+        data = await build()
+        artifact_cache.put(key, data)
+    sent = await answer_document(msg, BufferedInputFile(data, filename), caption)
+    if sent.document:
+        await artifact_cache.save_file_id(key, sent.document.file_id)
+
+# ================= CONCURRENCY =================
+def update_chat_id(update: Update) -> int:
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    user = getattr(event, "from_user", None)
+    return chat.id if chat else (user.id if user else update.update_id)
+
+class ChatLocks:
+    """Har bir chat uchun alohida lock - bitta o'quvchining bosishlari navbat bilan bajariladi"""
+
+    def __init__(self):
+        self._locks: Dict[int, list] = {}  # chat_id -> [Lock, kutayotganlar soni]
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @asynccontextmanager
+    async def hold(self, chat_id: int):
+        entry = self._locks.get(chat_id)
+        if entry is None:
+            entry = self._locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        if entry[0].locked():
+            self.contended += 1
+        start = time.monotonic()
+        try:
+            async with entry[0]:
+                waited = time.monotonic() - start
+                self.acquired += 1
+                self.wait_total += waited
+                metrics.observe("update_lock_wait_seconds", waited)
+                self.wait_max = max(self.wait_max, waited)
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(chat_id, None)
+
+    def summary(self) -> str:
+        avg_ms = self.wait_total / self.acquired * 1000 if self.acquired else 0
+        return (f"🔒 Lock: {self.acquired} ta | navbat: {self.contended} | "
+                f"o'rtacha kutish: {avg_ms:.1f} ms | max: {self.wait_max * 1000:.0f} ms")
+
+class LogContextMiddleware(BaseMiddleware):
+    """Log yozuvlari uchun user_id va (callback'dan) test_id"""
+    TEST_PREFIXES = {"ans", "nav", "goto", "finish", "finishyes", "finishno"}
+
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]):
+        inner = event.event
+        user = getattr(inner, "from_user", None)
+        log_user_id.set(user.id if user else None)
+        cb_data = getattr(inner, "data", None)
+        if isinstance(cb_data, str):
+            parts = cb_data.split("_")
+            if parts[0] in self.TEST_PREFIXES and len(parts) > 1:
+                log_test_id.set(parts[1])
+        return await handler(event, data)
+
+class FirstUpdateMiddleware(BaseMiddleware):
+    """Jarayon boshlanishidan birinchi update'gacha bo'lgan vaqt"""
+
+    def __init__(self):
+        self.seen = False
+
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]):
+        if not self.seen:
+            self.seen = True
+            ttfu = time.monotonic() - BOOT_TS
+            metrics.add("startup_first_update_seconds", ttfu)
+            log.info("Birinchi update: %.2f s", ttfu, extra={"ttfu_s": round(ttfu, 3)})
+        return await handler(event, data)
+
+class SerializeMiddleware(BaseMiddleware):
+    """Bir chat ichida ketma-ket, turli chatlar parallel (jami MAX_CONCURRENT_UPDATES gacha)"""
+
+    def __init__(self, locks: ChatLocks, limit: int):
+        self.locks = locks
+        self.slots = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]):
+        async with self.locks.hold(update_chat_id(event)):
+            async with self.slots:
+                return await handler(event, data)
 
 # ================= BOT =================
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=MongoStorage(fsm_col) if FSM_STORAGE == "mongo" else MemoryStorage())
 router = Router()
+chat_locks = ChatLocks()
+dp.update.outer_middleware(FirstUpdateMiddleware())
+dp.update.outer_middleware(LogContextMiddleware())
+dp.update.outer_middleware(SerializeMiddleware(chat_locks, MAX_CONCURRENT_UPDATES))
+router.message.middleware(HandlerTimingMiddleware())
+bot.session.middleware(ApiTimingMiddleware())
+
+# ================= CALLBACKS =================
+# Tugma ma'lumotlari - sep="_" bilan eski format saqlanadi (ans_<test_id>_<savol>_<javob>)
+class AnsCb(CallbackData, prefix="ans", sep="_"):
+    test_id: str
+    q: int
+    a: int
+
+class NavCb(CallbackData, prefix="nav", sep="_"):
+    test_id: str
+    direction: str
+
+class GotoCb(CallbackData, prefix="goto", sep="_"):
+    test_id: str
+    q: int
+
+class FinishCb(CallbackData, prefix="finish", sep="_"):
+    test_id: str
+
+class FinishYesCb(CallbackData, prefix="finishyes", sep="_"):
+    test_id: str
+
+class FinishNoCb(CallbackData, prefix="finishno", sep="_"):
+    test_id: str
+
+class GradeCb(CallbackData, prefix="grade", sep="_"):
+    grade: int
+
+class DiffCb(CallbackData, prefix="diff", sep="_"):
+    level: str
+
+class TopicCb(CallbackData, prefix="pintopic", sep="_"):
+    topic: int
+
+class DelTopicCb(CallbackData, prefix="deltopic", sep="_"):
+    topic: int
+
+class PinBatchCb(CallbackData, prefix="pinbatch", sep="_"):
+    batch: int
+
+class DashCb(CallbackData, prefix="dash", sep="_"):
+    batch: int
+
+class SessEndCb(CallbackData, prefix="sessend", sep="_"):
+    key: str  # batch_id, eski PIN'lar uchun PIN, yoki "all"
+    confirm: int = 0
+
+class CallbackTable:
+    """callback_data -> handler lug'ati: aniq qiymat yoki prefiks (birinchi "_" gacha) va FSM holati.
+    Filtrlarni ketma-ket tekshirish o'rniga 2-4 ta dict murojaati; takroriy ro'yxat - start'da xato"""
+
+    def __init__(self):
+        self.exact: Dict[tuple, tuple] = {}  # (data, holat) -> (CallableObject, None)
+        self.prefixed: Dict[tuple, tuple] = {}  # (prefiks, holat) -> (CallableObject, CallbackData klassi)
+
+    def on(self, key, state: Optional[State] = None):
+        """key: CallbackData klassi, "prefiks_" (startswith) yoki aniq qiymat"""
+        if isinstance(key, type):
+            table, name, cls = self.prefixed, key.__prefix__, key
+        elif key.endswith("_"):
+            table, name, cls = self.prefixed, key[:-1], None
+        else:
+            table, name, cls = self.exact, key, None
+        route = (name, state.state if state else None)
+        
+        def decorator(func):
+            if route in table:
+                raise RuntimeError(f"Callback takrorlangan: {route} - "
+                                   f"{table[route][0].callback.__name__} va {func.__name__}")
+            table[route] = (CallableObject(func), cls)
+            return func
+        return decorator
+
+    def resolve(self, data: str, state: Optional[str]) -> Optional[tuple]:
+        """Avval aniq qiymat, keyin prefiks; har birida avval joriy holat, keyin holatsiz"""
+        prefix = data.split("_", 1)[0]
+        for table, key in ((self.exact, data), (self.prefixed, prefix)):
+            route = table.get((key, state)) or table.get((key, None))
+            if route:
+                return route
+        return None
+
+callbacks = CallbackTable()
+
+@router.callback_query()
+async def dispatch_callback(cb: CallbackQuery, raw_state: Optional[str] = None, **data):
+    route = callbacks.resolve(cb.data or "", raw_state)
+    if not route:
+        await cb.answer()
+        return
+    handler, cls = route
+    if cls:
+        try:
+            data["callback_data"] = cls.unpack(cb.data)
+        except (ValueError, TypeError):
+            await cb.answer("❌ Xato!")
+            return
+    with handler_timer(handler.callback.__name__):
+        return await handler.call(cb, raw_state=raw_state, **data)
+
+def check_handlers():
+    """Bir xil nomli (bir-birini yashiradigan) handlerlar va jadvaldan tashqari callback handlerlar"""
+    for observer in (router.message, router.callback_query):
+        names = [h.callback.__name__ for h in observer.handlers]
+        duplicates = {n for n in names if names.count(n) > 1}
+        if duplicates:
+            raise RuntimeError(f"Takroriy handlerlar ({observer.event_name}): {', '.join(sorted(duplicates))}")
+    if len(router.callback_query.handlers) != 1:
+        raise RuntimeError("Callback handlerlar faqat callbacks.on(...) orqali ro'yxatga olinadi")
+
+# ================= TIMERS =================
+class TimerWheel:
+    """Hashed timing wheel: qo'shish/bekor qilish O(1), har soniyada faqat bitta slot ko'riladi"""
+
+    def __init__(self, slots: int = 512, tick: float = 1.0):
+        self.tick = tick
+        self.slots: List[Dict[str, tuple]] = [{} for _ in range(slots)]
+        self.where: Dict[str, int] = {}  # key -> slot
+        self.current = int(time.time() // tick)
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key: str, deadline_ts: float, payload: Any):
+        self.cancel(key)
+        t = max(int(deadline_ts // self.tick), self.current)
+        slot = t % len(self.slots)
+        self.slots[slot][key] = (t, payload)
+        self.where[key] = slot
+
+    def cancel(self, key: str):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            self.slots[slot].pop(key, None)
+
+    def advance(self, now_ts: float) -> list:
+        """now_ts gacha muddati tugaganlarni qaytarish"""
+        target = int(now_ts // self.tick)
+        due = []
+        while self.current <= target:
+            bucket = self.slots[self.current % len(self.slots)]
+            for key, (t, payload) in list(bucket.items()):
+                if t <= self.current:
+                    del bucket[key]
+                    self.where.pop(key, None)
+                    due.append(payload)
+            self.current += 1
+        return due
+
+timer_wheel = TimerWheel()
+
+class SessionRegistry:
+    """Shu jarayondagi faol testlar (taymer hujjatlari): to'plam/PIN bo'yicha indeks va har bir
+    sessiyaning taxminiy hajmi - test boshlangandagi FSM pickle uzunligi (javoblar bilan biroz
+    o'sadi, asosiy qismi - savollar). Barcha worker'lar bo'yicha ko'rinish timers_col'dan olinadi
+    (sessions_view)"""
+
+    def __init__(self):
+        self.sessions: Dict[str, dict] = {}  # test_id -> taymer hujjati + "bytes"
+        self.by_batch: Dict[str, set] = {}
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @staticmethod
+    def batch_key(doc: dict) -> str:
+        return doc.get("batch_id") or doc.get("pin") or "?"
+
+    def add(self, doc: dict, size: int = 0):
+        self.remove(doc["_id"])
+        entry = dict(doc, bytes=size)
+        self.sessions[doc["_id"]] = entry
+        self.by_batch.setdefault(self.batch_key(doc), set()).add(doc["_id"])
+        self.bytes += size
+        metrics.add("sessions_active", 1)
+        metrics.add("sessions_bytes", size)
+
+    def remove(self, test_id: str):
+        entry = self.sessions.pop(test_id, None)
+        if entry is None:
+            return
+        key = self.batch_key(entry)
+        ids = self.by_batch.get(key)
+        if ids is not None:
+            ids.discard(test_id)
+            if not ids:
+                del self.by_batch[key]
+        self.bytes -= entry["bytes"]
+        metrics.add("sessions_active", -1)
+        metrics.add("sessions_bytes", -entry["bytes"])
+
+session_registry = SessionRegistry()
+
+async def schedule_timer(s: dict, chat_id: int):
+    """Sessiya muddatini saqlash (restartdan keyin ham tiklanadi) va g'ildirakka qo'yish"""
+    deadline = s['started_at'] + timedelta(minutes=s['time_limit'])
+    doc = {
+        "_id": s['test_id'],
+        "chat_id": chat_id,
+        "user_id": s['user_id'],
+        "bot_id": bot.id,
+        "shard": chat_id % WORKERS,
+        "pin": s['pin'],
+        "batch_id": s.get('batch_id'),
+        "grade": s['grade'],
+        "topic": s['topic'],
+        "started_at": s['started_at'],
+        "bytes": len(pickle.dumps(s)),  # boshlanishdagi hajm
+        "deadline": deadline
+    }
+    await timers_col.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+    timer_wheel.schedule(doc["_id"], deadline.timestamp(), doc)
+    session_registry.add(doc, doc["bytes"])
+
+async def cancel_timer(test_id: str):
+    timer_wheel.cancel(test_id)
+    session_registry.remove(test_id)
+    await timers_col.delete_one({"_id": test_id})
+
+async def load_timers(shard: int = 0):
+    """Saqlangan muddatlarni g'ildirakka yuklash"""
+    count = 0
+    async for doc in timers_col.find({"shard": shard}):
+        timer_wheel.schedule(doc["_id"], doc["deadline"].timestamp(), doc)
+        session_registry.add(doc)  # hajmi noma'lum - sessiya MongoStorage'da
+        count += 1
+    return count
+
+def fsm_for(chat_id: int, user_id: int, bot_id: Optional[int] = None) -> FSMContext:
+    """Handler'dan tashqarida (taymer, fon vazifasi) foydalanuvchi holatiga kirish"""
+    key = StorageKey(bot_id=bot_id or bot.id, chat_id=chat_id, user_id=user_id)
+    return FSMContext(storage=dp.storage, key=key)
+
+async def end_session(doc: dict, notice: str) -> bool:
+    """Taymer hujjati bo'yicha testni yakunlash (natija odatdagidek hisoblanadi).
+    Chaqiruvchi shu chat lock'ini ushlab turmasligi kerak"""
+    state = fsm_for(doc["chat_id"], doc["user_id"], doc["bot_id"])
+    log_user_id.set(doc["user_id"])
+    log_test_id.set(doc["_id"])
+    async with chat_locks.hold(doc["chat_id"]):
+        data = await state.get_data()
+        s = data.get('session')
+        if not s or s.get('test_id') != doc["_id"]:
+            await cancel_timer(doc["_id"])
+            return False
+        await bot.send_message(doc["chat_id"], notice)
+        await finish_session(state, doc["chat_id"])
+        return True
+
+async def expire_session(doc: dict):
+    """Vaqti tugagan testni avtomatik yakunlash"""
+    try:
+        await end_session(doc, "⏱ Vaqt tugadi!")
+    except Exception:
+        log.exception("Timer xatosi (%s)", doc["_id"])
+
+drain_tasks = set()
+
+async def drain_loop(shard: int = 0):
+    """Admin `force` belgilagan testlarni yakunlash - har bir worker faqat o'z shard'idagilarni
+    (chat lock va FSM shu worker'da)"""
+    while True:
+        await asyncio.sleep(SESSION_DRAIN_SECONDS)
+        try:
+            async for doc in timers_col.find({"shard": shard, "force": True}):
+                try:
+                    await end_session(doc, "⏹ Test administrator tomonidan yakunlandi")
+                except Exception:
+                    log.exception("Majburiy yakunlash xatosi (%s)", doc["_id"])
+                    await timers_col.update_one({"_id": doc["_id"]}, {"$unset": {"force": ""}})
+        except Exception:
+            log.exception("Drain xatosi")
+
+async def wait_drained(query: dict, total: int, status: Message):
+    """Barcha shard'lar belgilangan testlarni yakunlaguncha kutish va admin'ga natija"""
+    deadline = time.monotonic() + 120
+    left = total
+    while left and time.monotonic() < deadline:
+        await asyncio.sleep(SESSION_DRAIN_SECONDS)
+        left = await timers_col.count_documents({**query, "force": True})
+    await status.edit_text(f"✅ Yakunlandi: {total - left}" + (f"\n⏳ Qoldi: {left}" if left else ""))
+
+expire_tasks = set()
+
+async def timer_loop():
+    while True:
+        await asyncio.sleep(timer_wheel.tick)
+        for doc in timer_wheel.advance(time.time()):
+            task = asyncio.create_task(expire_session(doc))
+            expire_tasks.add(task)
+            task.add_done_callback(expire_tasks.discard)
+
+# ================= DASHBOARD =================
+class EventBus:
+    """Jarayon ichidagi hodisalar (test_started, test_finished) - obunachilar sinxron chaqiriladi"""
+
+    def __init__(self):
+        self.handlers: Dict[str, list] = {}
+
+    def subscribe(self, kind: str, handler):
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def publish(self, kind: str, **event):
+        for handler in self.handlers.get(kind, []):
+            try:
+                handler(**event)
+            except Exception:
+                log.exception("Hodisa xatosi (%s)", kind)
+
+events = EventBus()
+
+def dashboard_text(doc: dict) -> str:
+    finished = doc.get("finished", 0)
+    avg = doc.get("score_sum", 0) / finished if finished else 0
+    return (f"📡 <b>Jonli panel</b>\n📚 {doc['grade']}-sinf | {doc['topic']}\n\n"
+            f"▶️ Boshlagan: {max(doc.get('started', 0), finished)}\n"
+            f"⏳ Jarayonda: {max(doc.get('started', 0) - finished, 0)}\n"
+            f"✅ Yakunlagan: {finished}/{doc['pin_count']}\n"
+            f"📊 O'rtacha: {avg:.1f}%\n\n"
+            f"🕒 {datetime.now():%H:%M:%S}")
+
+async def batch_totals(batch_id: str) -> dict:
+    """To'plam bo'yicha jami: yakunlanganlar results'dan, jarayondagilar barcha shard'lar taymerlaridan"""
+    totals = await results_col.aggregate([
+        {"$match": {"batch_id": batch_id}},
+        {"$group": {"_id": None, "finished": {"$sum": 1}, "score_sum": {"$sum": "$score"}}}
+    ]).to_list(1)
+    totals = totals[0] if totals else {"finished": 0, "score_sum": 0}
+    live = await timers_col.count_documents({"batch_id": batch_id})
+    return {"started": totals["finished"] + live, "finished": totals["finished"], "score_sum": totals["score_sum"]}
+
+class DashboardHub:
+    """PIN to'plami bo'yicha jonli panel. Hodisalar xotirada yig'iladi va har `interval` da bitta
+    bulk yozuv bilan panelni dirty qiladi; xabarni panel chat'ining shard'idagi worker tahrirlaydi -
+    bitta panel uchun intervalda ko'pi bilan bitta edit. Sonlar render'da batch_totals'dan olinadi:
+    bir nechta worker hodisalari ikki marta sanalmaydi"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.pending: set = set()  # hodisasi bo'lgan batch_id'lar
+        self.known: Dict[str, tuple] = {}  # batch_id -> (panel chat_id yoki None, tekshirilgan vaqt)
+        events.subscribe("test_started", self.on_event)
+        events.subscribe("test_finished", self.on_event)
+
+    def on_event(self, batch_id: Optional[str] = None, **_):
+        if batch_id:
+            self.pending.add(batch_id)
+
+    def opened(self, batch_id: str, chat_id: int):
+        self.known[batch_id] = (chat_id, time.monotonic())
+
+    async def panel_chat(self, batch_id: Optional[str]) -> Optional[int]:
+        """To'plam paneli qaysi chatda (boshqa worker ochgan bo'lishi mumkin) - interval davomida keshlanadi"""
+        if not batch_id:
+            return None
+        cached = self.known.get(batch_id)
+        if cached and time.monotonic() - cached[1] < self.interval:
+            return cached[0]
+        doc = await dashboards_col.find_one({"_id": batch_id}, {"chat_id": 1})
+        chat_id = doc["chat_id"] if doc else None
+        self.known[batch_id] = (chat_id, time.monotonic())
+        return chat_id
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, set()
+        try:
+            # Panelsiz to'plamlar uchun upsert yo'q - yozuv hech narsani o'zgartirmaydi
+            await dashboards_col.bulk_write([
+                UpdateOne({"_id": batch_id}, {"$set": {"dirty": True}}) for batch_id in pending
+            ], ordered=False)
+        except Exception:
+            self.pending |= pending
+            raise
+
+    async def render(self, shard: int = 0) -> int:
+        edited, done = 0, []
+        while True:
+            doc = await dashboards_col.find_one_and_update(
+                {"shard": shard, "dirty": True, "_id": {"$nin": done}}, {"$set": {"dirty": False}}
+            )
+            if not doc:
+                return edited
+            done.append(doc["_id"])
+            try:
+                doc.update(await batch_totals(doc["_id"]))
+                await bot.edit_message_text(dashboard_text(doc), chat_id=doc["chat_id"],
+                                            message_id=doc["message_id"], parse_mode="HTML")
+                edited += 1
+            except TelegramBadRequest as e:
+                if "not modified" not in str(e):
+                    # Xabar o'chirilgan - panel yopiladi, admin xabarlari qaytadi
+                    log.warning("Panel yopildi (%s): %s", doc["_id"], e)
+                    await dashboards_col.delete_one({"_id": doc["_id"]})
+                    self.known.pop(doc["_id"], None)
+            except Exception:
+                log.exception("Panel tahrirlash xatosi (%s)", doc["_id"])
+                await dashboards_col.update_one({"_id": doc["_id"]}, {"$set": {"dirty": True}})
+
+dashboard_hub = DashboardHub(DASHBOARD_SECONDS)
+
+async def dashboard_loop(shard: int = 0):
+    while True:
+        await asyncio.sleep(dashboard_hub.interval)
+        try:
+            await dashboard_hub.flush()
+            await dashboard_hub.render(shard)
+        except Exception:
+            log.exception("Panel xatosi")
+
+# ================= IMPORT JOBS =================
+# Word import holati: parsing -> parsed -> committing -> committed (yoki failed/expired).
+# Savollar import_staging ga IMPORT_CHUNK bo'lib yoziladi, `parsed` - tiklanish nuqtasi.
+import_tasks = set()
+
+def spawn_import(coro):
+    task = asyncio.create_task(coro)
+    import_tasks.add(task)
+    task.add_done_callback(import_tasks.discard)
+
+async def import_status(job: dict, text: str, reply_markup=None):
+    try:
+        await bot.edit_message_text(text, chat_id=job["chat_id"], message_id=job["status_message_id"],
+                                    reply_markup=reply_markup)
+    except Exception as e:
+        log.debug("Import status xatosi: %s", e)
+
+async def run_import_job(job_id: str):
+    """Faylni yuklab olish va savollarni staging'ga bo'laklab yozish (to'xtagan joydan davom etadi)"""
+    job = await import_jobs_col.find_one({"_id": job_id, "status": "parsing"})
+    if not job:
+        return
+    log_user_id.set(job["admin_id"])
+    path = f"temp_{job_id}.docx"
+    parsed, images = job["parsed"], job["images"]
+    ops = []
+    last_edit = time.monotonic()
+    
+    async def flush():
+        nonlocal ops
+        if ops:
+            await import_staging_col.bulk_write(ops, ordered=False)
+            ops = []
+        await import_jobs_col.update_one({"_id": job_id}, {"$set": {"parsed": parsed, "images": images}})
+    
+    try:
+        file = await bot.get_file(job["file_id"])
+        await bot.download_file(file.file_path, path)
+        
+        idx = 0
+        async for para_idx, total, q in iter_word_questions(path, skip=parsed):
+            if idx < parsed:
+                idx += 1
+                continue
+            ops.append(UpdateOne({"job_id": job_id, "idx": idx}, {"$set": {"q": q}}, upsert=True))
+            idx += 1
+            parsed, images = idx, images + len(q.get('images', []))
+            if len(ops) >= IMPORT_CHUNK:
+                await flush()
+                if time.monotonic() - last_edit >= IMPORT_PROGRESS_SECONDS:
+                    last_edit = time.monotonic()
+                    await import_status(job, f"⏳ {para_idx * 100 // max(total, 1)}% | "
+                                             f"{parsed} ta savol, {images} ta rasm...")
+        await flush()
+    except Exception as e:
+        log.exception("Word import xatosi")
+        await import_jobs_col.update_one({"_id": job_id}, {"$set": {"status": "failed", "error": str(e)}})
+        await import_staging_col.delete_many({"job_id": job_id})
+        await import_status(job, f"❌ Xato: {e}")
+        return
+    finally:
+        if os.path.exists(path): os.remove(path)
+    
+    if not parsed:
+        await import_jobs_col.update_one({"_id": job_id}, {"$set": {"status": "failed", "error": "empty"}})
+        await import_status(job, "❌ Savollar topilmadi!")
+        return
+    job = await import_jobs_col.find_one_and_update(
+        {"_id": job_id}, {"$set": {"status": "parsed"}}, return_document=True
+    )
+    await prompt_import_grade(job)
+
+async def prompt_import_grade(job: dict):
+    """Parse tugadi - admin'dan sinf/mavzu/qiyinlikni so'rash"""
+    await import_status(
+        job,
+        f"✅ {job['parsed']} ta savol topildi!\n"
+        f"🖼 {job['images']} ta rasm yuklandi\n\n"
+        "Sinf tanlang:",
+        reply_markup=grade_kb()
+    )
+    state = fsm_for(job["chat_id"], job["admin_id"])
+    async with chat_locks.hold(job["chat_id"]):
+        await state.set_state(AdminStates.waiting_grade)
+        await state.set_data({"import_job": job["_id"]})
+
+async def _apply_staging(job: dict, job_id: Optional[str], label: str) -> dict:
+    counts = {"new": 0, "updated": 0, "unchanged": 0}
+    
+    async def flush(batch):
+        result = await upsert_questions(batch, job['grade'], job['topic'], job['difficulty'], job['admin_id'], job_id)
+        for k in counts:
+            counts[k] += result[k]
+    
+    batch = []
+    done = 0
+    last_edit = time.monotonic()
+    async for doc in import_staging_col.find({"job_id": job["_id"]}).sort("idx", 1):
+        batch.append(doc["q"])
+        if len(batch) >= IMPORT_CHUNK:
+            await flush(batch)
+            done += len(batch)
+            batch = []
+            if time.monotonic() - last_edit >= IMPORT_PROGRESS_SECONDS:
+                last_edit = time.monotonic()
+                await import_status(job, f"⏳ {label}: {done}/{job['parsed']}")
+    if batch:
+        await flush(batch)
+    return counts
+
+async def commit_import_job(job: dict) -> dict:
+    """Staging'dagi savollarni questions ga yozish, testlarga birdaniga ko'rinadigan qilib:
+    1) yangilari pending_job belgisi bilan yoziladi (test_name ularni ko'rmaydi);
+    2) bitta update_many belgini olib tashlaydi, keyin mavjud savollar yangilanadi.
+    Har bir bosqich idempotent - uzilgan commit resume_import_jobs'da qayta ishga tushadi"""
+    if job.get("phase") != "publish":
+        await _apply_staging(job, job["_id"], "Savollar saqlanmoqda")
+        new = await questions_col.count_documents({"pending_job": job["_id"]})
+        job = await import_jobs_col.find_one_and_update(
+            {"_id": job["_id"]}, {"$set": {"phase": "publish", "new": new}}, return_document=True
+        )
+    await questions_col.update_many({"pending_job": job["_id"]}, {"$unset": {"pending_job": ""}})
+    counts = await _apply_staging(job, None, "Savollar yangilanmoqda")
+    counts["new"] = job["new"]
+    counts["unchanged"] = max(job["parsed"] - counts["new"] - counts["updated"], 0)
+    
+    await import_jobs_col.update_one(
+        {"_id": job["_id"]},
+        {"$set": {"status": "committed", "counts": counts, "finished_at": datetime.now()}}
+    )
+    await import_staging_col.delete_many({"job_id": job["_id"]})
+    await import_status(job, f"✅ {job['parsed']} savol qayta ishlandi!\n\n{ingest_report(counts)}")
+    return counts
+
+async def run_commit_job(job: dict):
+    """Commit xatosi: yashirin yangi savollar va staging o'chiriladi, job failed - admin qayta yuklaydi"""
+    try:
+        await commit_import_job(job)
+    except Exception as e:
+        log.exception("Import saqlash xatosi")
+        await questions_col.delete_many({"pending_job": job["_id"]})
+        await import_staging_col.delete_many({"job_id": job["_id"]})
+        await import_jobs_col.update_one({"_id": job["_id"]}, {"$set": {"status": "failed", "error": str(e)}})
+        await import_status(job, f"❌ Xato: {e}")
+
+async def resume_import_jobs(shard: int = 0):
+    """Restartdan keyin: yarim qolgan parse/commit'ni davom ettirish, parse bo'lganlarini qayta so'rash.
+    Eski parsing/parsed job'lar bekor qilinadi; committing hech qachon - yarim yozilgan savollar qolmasin"""
+    cutoff = datetime.now() - timedelta(days=1)
+    try:
+        async for job in import_jobs_col.find({"shard": shard, "status": {"$in": ["parsing", "parsed", "committing"]}}):
+            if job["status"] != "committing" and job["created_at"] < cutoff:
+                await import_jobs_col.update_one({"_id": job["_id"]}, {"$set": {"status": "expired"}})
+                await import_staging_col.delete_many({"job_id": job["_id"]})
+            elif job["status"] == "parsing":
+                spawn_import(run_import_job(job["_id"]))
+            elif job["status"] == "parsed":
+                spawn_import(prompt_import_grade(job))
+            else:
+                spawn_import(run_commit_job(job))
+    except Exception:
+        log.exception("Importlarni tiklash xatosi")
+
+# ================= BACKUP =================
+# Format: gzip JSONL (bson.json_util), birinchi qator - meta, keyin {"t": "image"} va {"t": "question"}.
+# Har bir rasm uni ishlatgan birinchi savoldan oldin yoziladi - import bir o'tishda, bo'laklab ishlaydi.
+BACKUP_VERSION = 1
+
+def _dump_line(kind: str, doc: dict) -> str:
+    return json_util.dumps({"t": kind, **doc}, ensure_ascii=False) + "\n"
+
+async def export_backup(path: str) -> dict:
+    """Savollar bazasi va ular ishlatgan rasmlarni faylga oqim bilan yozish (xotira - bitta bo'lak)"""
+    counts = {"questions": 0, "images": 0}
+    written = set()  # yozilgan rasm id'lari
+    
+    async def flush(f, batch):
+        ids = {i for q in batch for i in q.get('images', [])} - written
+        lines = []
+        if ids:
+            object_ids = [ObjectId(i) for i in ids if ObjectId.is_valid(i)]
+            async for img in images_col.find({"_id": {"$in": object_ids}}):
+                lines.append(_dump_line("image", img))
+                counts["images"] += 1
+            written.update(ids)
+        lines += [_dump_line("question", q) for q in batch]
+        counts["questions"] += len(batch)
+        await asyncio.to_thread(f.writelines, lines)
+    
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(_dump_line("meta", {"version": BACKUP_VERSION, "created_at": datetime.now()}))
+        batch = []
+        async for q in questions_col.find(VISIBLE).batch_size(BACKUP_CHUNK):  # yarim import kirmaydi
+            batch.append(q)
+            if len(batch) >= BACKUP_CHUNK:
+                await flush(f, batch)
+                batch = []
+        if batch:
+            await flush(f, batch)
+    return counts
+
+async def _restore_images(docs: List[dict], id_map: Dict[str, str], counts: dict):
+    """Rasmlarni hash bo'yicha qo'shish; bazada bor bo'lsa mavjud id ishlatiladi"""
+    existing = {img["hash"]: str(img["_id"])
+                async for img in images_col.find({"hash": {"$in": [d["hash"] for d in docs]}}, {"hash": 1})}
+    fresh = []
+    for d in docs:
+        if d["hash"] in existing:
+            id_map[str(d["_id"])] = existing[d["hash"]]
+            counts["images_dup"] += 1
+        else:
+            fresh.append(d)
+    if not fresh:
+        return
+    try:
+        await images_col.insert_many(fresh, ordered=False)
+    except BulkWriteError:
+        # Parallel yuklash yoki _id to'qnashuvi - hash bo'yicha qayta aniqlaymiz
+        log.warning("Backup: rasm yozishda to'qnashuv, hash bo'yicha tekshirilmoqda")
+    saved = {img["hash"]: str(img["_id"])
+             async for img in images_col.find({"hash": {"$in": [d["hash"] for d in fresh]}}, {"hash": 1})}
+    for d in fresh:
+        old_id = str(d.pop("_id"))
+        if d["hash"] not in saved:
+            saved[d["hash"]] = str((await images_col.insert_one(d)).inserted_id)
+        id_map[old_id] = saved[d["hash"]]
+        counts["images_new"] += 1
+        if phash_ready and d.get("phash"):
+            phash_index.add(int(d["phash"], 16), saved[d["hash"]])
+
+async def _restore_questions(docs: List[dict], id_map: Dict[str, str], counts: dict):
+    """upsert_questions bilan bir xil qoida: fingerprint bo'yicha, identifikatsiya maydonlari faqat qo'shishda"""
+    ops = []
+    seen = set()
+    for q in docs:
+        fp = q.get('fingerprint') or question_fingerprint(q, q['grade'], q['topic'])
+        if fp in seen:
+            counts["unchanged"] += 1
+            continue
+        seen.add(fp)
+        ops.append(UpdateOne({"fingerprint": fp}, {
+            "$set": {
+                'answer': q['answer'],
+                'images': [id_map.get(i, i) for i in q.get('images', [])],
+                'type': q.get('type', 'choice'),
+                'explanation': q.get('explanation', ''),
+                'difficulty': q.get('difficulty', "Bilish")
+            },
+            "$setOnInsert": {
+                'fingerprint': fp,
+                'text': q['text'],
+                'options': q.get('options', []),
+                'grade': q['grade'],
+                'topic': q['topic'],
+                'created_at': q.get('created_at', datetime.now()),
+                'created_by': q.get('created_by')
+            }
+        }, upsert=True))
+    if ops:
+        result = await bulk_upsert_questions(ops)
+        counts["new"] += result.upserted_count
+        counts["updated"] += result.modified_count
+        counts["unchanged"] += result.matched_count - result.modified_count
+
+async def import_backup(path: str) -> dict:
+    """Backup faylni bo'laklab o'qish: rasmlar hash bo'yicha, savollar fingerprint bo'yicha bulk upsert"""
+    counts = {"new": 0, "updated": 0, "unchanged": 0, "images_new": 0, "images_dup": 0}
+    id_map: Dict[str, str] = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        meta = json_util.loads(await asyncio.to_thread(f.readline) or "{}")
+        if meta.get("t") != "meta" or meta.get("version") != BACKUP_VERSION:
+            raise ValueError("Backup formati noto'g'ri")
+        while True:
+            lines = await asyncio.to_thread(lambda: list(islice(f, BACKUP_CHUNK)))
+            if not lines:
+                break
+            images, questions = [], []
+            for line in lines:
+                doc = json_util.loads(line)
+                kind = doc.pop("t", None)
+                if kind == "image":
+                    images.append(doc)
+                elif kind == "question":
+                    doc.pop("_id", None)
+                    questions.append(doc)
+            if images:
+                await _restore_images(images, id_map, counts)
+            if questions:
+                await _restore_questions(questions, id_map, counts)
+    return counts
 
 # ================= KEYBOARDS =================
 def admin_menu():
@@ -374,17 +2445,17 @@ def student_menu():
 
 def grade_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="7-sinf", callback_data="grade_7")],
-        [InlineKeyboardButton(text="8-sinf", callback_data="grade_8")],
-        [InlineKeyboardButton(text="9-sinf", callback_data="grade_9")]
+        [InlineKeyboardButton(text="7-sinf", callback_data=GradeCb(grade=7).pack())],
+        [InlineKeyboardButton(text="8-sinf", callback_data=GradeCb(grade=8).pack())],
+        [InlineKeyboardButton(text="9-sinf", callback_data=GradeCb(grade=9).pack())]
     ])
 
 def diff_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📗 Bilish", callback_data="diff_bilish")],
-        [InlineKeyboardButton(text="📙 Qo'llash", callback_data="diff_qollash")],
-        [InlineKeyboardButton(text="📕 Mulohaza", callback_data="diff_mulohaza")],
-        [InlineKeyboardButton(text="🔀 Aralash", callback_data="diff_aralash")]
+        [InlineKeyboardButton(text="📗 Bilish", callback_data=DiffCb(level="bilish").pack())],
+        [InlineKeyboardButton(text="📙 Qo'llash", callback_data=DiffCb(level="qollash").pack())],
+        [InlineKeyboardButton(text="📕 Mulohaza", callback_data=DiffCb(level="mulohaza").pack())],
+        [InlineKeyboardButton(text="🔀 Aralash", callback_data=DiffCb(level="aralash").pack())]
     ])
 
 def pin_settings_kb():
@@ -401,7 +2472,7 @@ def pin_management_kb():
         [InlineKeyboardButton(text="📊 Statistika", callback_data="pinmgmt_stats")]
     ])
 
-def navigation_kb(current: int, total: int, answers: dict, idx: int):
+def navigation_kb(current: int, total: int, answers: dict, idx: str):
     """Navigatsiya klaviaturasi - YANGILANGAN"""
     buttons = []
     
@@ -424,7 +2495,7 @@ def navigation_kb(current: int, total: int, answers: dict, idx: int):
             
             row.append(InlineKeyboardButton(
                 text=text,
-                callback_data=f"goto_{idx}_{j}"
+                callback_data=GotoCb(test_id=idx, q=j).pack()
             ))
         rows.append(row)
     
@@ -433,7 +2504,7 @@ def navigation_kb(current: int, total: int, answers: dict, idx: int):
     # Navigatsiya tugmalari
     nav_row = []
     if current > 0:
-        nav_row.append(InlineKeyboardButton(text="⬅️ Oldingi", callback_data=f"nav_{idx}_prev"))
+        nav_row.append(InlineKeyboardButton(text="⬅️ Oldingi", callback_data=NavCb(test_id=idx, direction="prev").pack()))
     
     nav_row.append(InlineKeyboardButton(
         text=f"📊 {current+1}/{total}",
@@ -441,19 +2512,19 @@ def navigation_kb(current: int, total: int, answers: dict, idx: int):
     ))
     
     if current < total - 1:
-        nav_row.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data=f"nav_{idx}_next"))
+        nav_row.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data=NavCb(test_id=idx, direction="next").pack()))
     
     buttons.append(nav_row)
     
     # Tugallash tugmasi
     buttons.append([InlineKeyboardButton(
         text="✅ Testni yakunlash",
-        callback_data=f"finish_{idx}"
+        callback_data=FinishCb(test_id=idx).pack()
     )])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def ans_kb(options: List[str], idx: int, current: int):
+def ans_kb(options: List[str], idx: str, current: int):
     """Javob variantlari klaviaturasi"""
     buttons = []
     for i, opt in enumerate(options):
@@ -461,21 +2532,31 @@ def ans_kb(options: List[str], idx: int, current: int):
         text = f"{letter}) {opt[:40]}{'...' if len(opt) > 40 else ''}"
         buttons.append([InlineKeyboardButton(
             text=text,
-            callback_data=f"ans_{idx}_{current}_{i}"
+            callback_data=AnsCb(test_id=idx, q=current, a=i).pack()
         )])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 # ================= HANDLERS =================
+async def register_user(msg: Message):
+    """O'quvchini users ga yozish (adminlar ro'yxatga olinmaydi)"""
+    if msg.from_user.id in ADMIN_IDS:
+        return
+    await users_col.update_one(
+        {"user_id": msg.from_user.id},
+        {"$set": {"user_id": msg.from_user.id, "name": msg.from_user.full_name, "reg": datetime.now()}},
+        upsert=True
+    )
+
 @router.message(Command("start"))
-async def cmd_start(msg: Message):
+async def cmd_start(msg: Message, state: FSMContext, command: CommandObject):
+    # t.me/<bot>?start=<pin> - PIN'li havola yoki QR kod
+    if command.args:
+        await start_with_pin(msg, state, command.args.strip())
+        return
     if msg.from_user.id in ADMIN_IDS:
         await msg.answer("👋 Salom Admin!\n\n📚 Fizika Test Bot", reply_markup=admin_menu())
     else:
-        await users_col.update_one(
-            {"user_id": msg.from_user.id},
-            {"$set": {"user_id": msg.from_user.id, "name": msg.from_user.full_name, "reg": datetime.now()}},
-            upsert=True
-        )
+        await register_user(msg)
         await msg.answer("👋 Fizika Test Botiga xush kelibsiz!", reply_markup=student_menu())
 
 # ===== WORD UPLOAD =====
@@ -500,33 +2581,27 @@ async def process_word(msg: Message, state: FSMContext):
         await msg.answer("❌ Faqat .docx!"); return
     
     status = await msg.answer("⏳ Yuklanmoqda va rasmlar qayta ishlanmoqda...")
-    file = await bot.get_file(msg.document.file_id)
-    path = f"temp_{msg.from_user.id}.docx"
-    await bot.download_file(file.file_path, path)
-    
-    try:
-        questions = await parse_word_with_images(path)
-        if not questions:
-            await status.edit_text("❌ Savollar topilmadi!"); return
-        
-        images_count = sum(len(q.get('images', [])) for q in questions)
-        await state.update_data(questions=questions)
-        await status.edit_text(
-            f"✅ {len(questions)} ta savol topildi!\n"
-            f"🖼 {images_count} ta rasm yuklandi\n\n"
-            "Sinf tanlang:",
-            reply_markup=grade_kb()
-        )
-        await state.set_state(AdminStates.waiting_grade)
-    except Exception as e:
-        await status.edit_text(f"❌ Xato: {e}")
-        print(f"Word parse error: {e}")
-    finally:
-        if os.path.exists(path): os.remove(path)
+    job_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
+    await import_jobs_col.insert_one({
+        "_id": job_id,
+        "admin_id": msg.from_user.id,
+        "chat_id": msg.chat.id,
+        "shard": msg.chat.id % WORKERS,
+        "file_id": msg.document.file_id,
+        "file_name": msg.document.file_name,
+        "status": "parsing",
+        "parsed": 0,
+        "images": 0,
+        "status_message_id": status.message_id,
+        "created_at": datetime.now()
+    })
+    await state.clear()
+    # Parse fonda - handler (va chat qulfi) darhol bo'shaydi
+    spawn_import(run_import_job(job_id))
 
-@router.callback_query(AdminStates.waiting_grade, F.data.startswith("grade_"))
-async def word_grade(cb: CallbackQuery, state: FSMContext):
-    grade = int(cb.data.split("_")[1])
+@callbacks.on(GradeCb, state=AdminStates.waiting_grade)
+async def word_grade(cb: CallbackQuery, state: FSMContext, callback_data: GradeCb):
+    grade = callback_data.grade
     await state.update_data(grade=grade)
     await cb.message.edit_text(f"📚 {grade}-sinf\n\nMavzu nomini yozing:")
     await state.set_state(AdminStates.waiting_topic)
@@ -537,26 +2612,24 @@ async def word_topic(msg: Message, state: FSMContext):
     await msg.answer("Qiyinlik darajasini tanlang:", reply_markup=diff_kb())
     await state.set_state(AdminStates.waiting_difficulty)
 
-@router.callback_query(AdminStates.waiting_difficulty, F.data.startswith("diff_"))
-async def word_diff(cb: CallbackQuery, state: FSMContext):
+@callbacks.on(DiffCb, state=AdminStates.waiting_difficulty)
+async def word_diff(cb: CallbackQuery, state: FSMContext, callback_data: DiffCb):
     diff_map = {"bilish": "Bilish", "qollash": "Qo'llash", "mulohaza": "Mulohaza", "aralash": "Aralash"}
-    diff = diff_map.get(cb.data.split("_")[1], "Aralash")
+    diff = diff_map.get(callback_data.level, "Aralash")
     data = await state.get_data()
+    await state.clear()
     
     status = await cb.message.edit_text("⏳ Savollar saqlanmoqda...")
     
-    for q in data['questions']:
-        q.update({
-            'grade': data['grade'],
-            'topic': data['topic'],
-            'difficulty': diff if diff != "Aralash" else random.choice(["Bilish", "Qo'llash", "Mulohaza"]),
-            'created_at': datetime.now(),
-            'created_by': cb.from_user.id
-        })
-        await questions_col.insert_one(q)
-    
-    await status.edit_text(f"✅ {len(data['questions'])} savol saqlandi!")
-    await state.clear()
+    job = await import_jobs_col.find_one_and_update(
+        {"_id": data.get('import_job'), "status": {"$in": ["parsed", "committing"]}},
+        {"$set": {"status": "committing", "grade": data['grade'], "topic": data['topic'], "difficulty": diff,
+                  "status_message_id": status.message_id}},
+        return_document=True
+    )
+    if not job:
+        await status.edit_text("❌ Import topilmadi yoki allaqachon saqlangan!"); return
+    spawn_import(run_commit_job(job))
 
 # ===== MANUAL ADD =====
 @router.message(F.text == "➕ Savol qo'shish")
@@ -565,9 +2638,9 @@ async def add_q(msg: Message, state: FSMContext):
     await msg.answer("Sinf:", reply_markup=grade_kb())
     await state.set_state(AdminStates.add_manual_question)
 
-@router.callback_query(AdminStates.add_manual_question, F.data.startswith("grade_"))
-async def add_q_grade(cb: CallbackQuery, state: FSMContext):
-    await state.update_data(grade=int(cb.data.split("_")[1]))
+@callbacks.on(GradeCb, state=AdminStates.add_manual_question)
+async def add_q_grade(cb: CallbackQuery, state: FSMContext, callback_data: GradeCb):
+    await state.update_data(grade=callback_data.grade)
     await cb.message.edit_text("Mavzu nomini kiriting:")
     await state.set_state(AdminStates.add_manual_topic)
 
@@ -611,26 +2684,24 @@ async def add_q_opts(msg: Message, state: FSMContext):
         btns = [[InlineKeyboardButton(text=f"{chr(65+i)}) {o}", callback_data=f"correct_{i}")] for i, o in enumerate(opts)]
         await msg.answer("To'g'ri javobni tanlang:", reply_markup=InlineKeyboardMarkup(inline_keyboard=btns))
 
-@router.callback_query(F.data.startswith("correct_"))
+@callbacks.on("correct_")
 async def add_q_correct(cb: CallbackQuery, state: FSMContext):
     ans = int(cb.data.split("_")[1])
     data = await state.get_data()
     
-    await questions_col.insert_one({
+    counts = await upsert_questions([{
         'text': data['q_text'],
         'options': data['options'],
         'answer': ans,
         'images': data.get('images', []),
         'type': 'choice',
-        'explanation': '',
-        'grade': data['grade'],
-        'topic': data['topic'],
-        'difficulty': 'Bilish',
-        'created_at': datetime.now(),
-        'created_by': cb.from_user.id
-    })
+        'explanation': ''
+    }], data['grade'], data['topic'], 'Bilish', cb.from_user.id)
     
-    await cb.message.edit_text(f"✅ Savol saqlandi!\n🖼 {len(data.get('images', []))} ta rasm")
+    if counts['unchanged']:
+        await cb.message.edit_text("♻️ Bu savol bazada allaqachon bor!")
+    else:
+        await cb.message.edit_text(f"✅ Savol saqlandi!\n🖼 {len(data.get('images', []))} ta rasm")
     await state.clear()
 
 # ===== PIN CREATION =====
@@ -640,35 +2711,39 @@ async def create_pin(msg: Message, state: FSMContext):
     await msg.answer("Sinf:", reply_markup=grade_kb())
     await state.update_data(action="create_pin")
 
-@router.callback_query(F.data.startswith("grade_"))
-async def pin_grade(cb: CallbackQuery, state: FSMContext):
+@callbacks.on(GradeCb)
+async def pin_grade(cb: CallbackQuery, state: FSMContext, callback_data: GradeCb):
     data = await state.get_data()
     if data.get('action') != 'create_pin': return
     
-    grade = int(cb.data.split("_")[1])
-    topics = await questions_col.distinct("topic", {"grade": grade})
+    grade = callback_data.grade
+    topics = await questions_col.distinct("topic", {"grade": grade, **VISIBLE})
     
     if not topics:
         await cb.message.edit_text("❌ Savollar yo'q!")
         return
     
     await state.update_data(grade=grade)
-    btns = [[InlineKeyboardButton(text=t, callback_data=f"pintopic_{t}")] for t in topics]
+    btns = [[InlineKeyboardButton(text=t, callback_data=TopicCb(topic=await topic_registry.id_for(t)).pack())]
+            for t in topics]
     await cb.message.edit_text("Mavzu:", reply_markup=InlineKeyboardMarkup(inline_keyboard=btns))
 
-@router.callback_query(F.data.startswith("pintopic_"))
-async def pin_topic(cb: CallbackQuery, state: FSMContext):
-    topic = cb.data.replace("pintopic_", "")
+@callbacks.on(TopicCb)
+async def pin_topic(cb: CallbackQuery, state: FSMContext, callback_data: TopicCb):
+    topic = await topic_registry.name_for(callback_data.topic)
+    if topic is None:
+        await cb.answer("❌ Topilmadi!")
+        return
     await state.update_data(topic=topic)
-    await cb.message.edit_text(f"📝 {topic}\n\nNechta PIN? (1-100):")
+    await cb.message.edit_text(f"📝 {topic}\n\nNechta PIN? (1-{PIN_BATCH_MAX}):")
     await state.set_state(AdminStates.pin_count)
 
 @router.message(AdminStates.pin_count)
 async def pin_count(msg: Message, state: FSMContext):
     try:
         count = int(msg.text.strip())
-        if count < 1 or count > 100:
-            await msg.answer("❌ 1-100!")
+        if count < 1 or count > PIN_BATCH_MAX:
+            await msg.answer(f"❌ 1-{PIN_BATCH_MAX}!")
             return
     except:
         await msg.answer("❌ Raqam!")
@@ -677,7 +2752,7 @@ async def pin_count(msg: Message, state: FSMContext):
     await state.update_data(pin_count=count)
     await msg.answer(f"✅ {count} ta PIN\n\nSozlamalar:", reply_markup=pin_settings_kb())
 
-@router.callback_query(F.data.startswith("pinset_"))
+@callbacks.on("pinset_")
 async def pin_settings(cb: CallbackQuery, state: FSMContext):
     setting = cb.data.split("_")[1]
     
@@ -728,6 +2803,83 @@ async def pin_config(msg: Message, state: FSMContext):
     
     await create_batch_pins(msg, state)
 
+async def insert_pins(docs: List[dict]):
+    """Bo'lakni yozish. Allocator PIN'lari o'zaro takrorlanmaydi; unique index faqat
+    allocator'dan oldin tasodifiy yaratilgan eski PIN'ga urilishi mumkin - unga yangi qiymat beriladi"""
+    while docs:
+        try:
+            await pins_col.insert_many(docs, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            docs = [docs[err["index"]] for err in errors]
+            for doc, pin in zip(docs, await allocate_pins(len(docs))):
+                doc.pop("_id", None)
+                doc["pin"] = pin
+            metrics.inc("pin_collisions_total", len(docs))
+
+async def send_batch_files(msg: Message, batch: dict):
+    """PIN'larni kursor bilan o'qib PDF qismlari (PIN_PDF_PART tadan) va JSON faylni yuborish.
+    To'plam o'zgarmaydi - avval yuborilgan fayllar file_id bilan qayta jo'natiladi"""
+    filename = batch['topic'].replace('/', '-')[:30]
+    parts = max(1, -(-batch['pin_count'] // PIN_PDF_PART))
+    pdf_caption = "📄 PDF format - chop etish uchun"
+    pdf_keys = [artifact_key("pins_pdf", batch['batch_id'], part) for part in range(1, parts + 1)]
+    json_key = artifact_key("pins_json", batch['batch_id'])
+    
+    file_ids = [await artifact_cache.file_id(key) for key in pdf_keys + [json_key]]
+    if all(file_ids):
+        try:
+            for part, file_id in enumerate(file_ids[:-1], 1):
+                await answer_document(msg, file_id, pdf_caption + (f" ({part}/{parts})" if parts > 1 else ""))
+            await answer_document(msg, file_ids[-1], "💾 JSON format")
+            return
+        except TelegramBadRequest:
+            for key in pdf_keys + [json_key]:
+                await artifact_cache.forget_file_id(key)
+    
+    username = (await bot.me()).username
+    json_path = f"pins_{batch['batch_id']}.json"
+    writer = PinsJsonWriter(json_path, batch)
+    try:
+        chunk, part = [], 0
+        
+        async def send_part():
+            nonlocal chunk, part
+            part += 1
+            writer.write(chunk)
+            label = f"{part}/{parts}" if parts > 1 else None
+            suffix = f"_{part}" if parts > 1 else ""
+            pins = chunk
+            await send_artifact(
+                msg, pdf_keys[part - 1],
+                lambda: asyncio.to_thread(generate_pins_pdf, pins, batch, username, label),
+                f"PIN_{batch['grade']}_{filename}{suffix}.pdf",
+                pdf_caption + (f" ({label})" if label else "")
+            )
+            chunk = []
+        
+        async for pin in pins_col.find({"batch_id": batch['batch_id']}, {"pin": 1, "number": 1}).sort("number", 1):
+            chunk.append(pin)
+            if len(chunk) >= PIN_PDF_PART:
+                await send_part()
+        if chunk:
+            await send_part()
+        writer.close()
+        
+        def read_json():
+            with open(json_path, "rb") as f:
+                return f.read()
+        
+        await send_artifact(msg, json_key, lambda: asyncio.to_thread(read_json),
+                            f"PIN_{batch['grade']}_{filename}.json", "💾 JSON format")
+    finally:
+        if not writer.f.closed:
+            writer.f.close()
+        if os.path.exists(json_path): os.remove(json_path)
+
 async def create_batch_pins(msg: Message, state: FSMContext):
     data = await state.get_data()
     
@@ -741,19 +2893,38 @@ async def create_batch_pins(msg: Message, state: FSMContext):
     
     status = await msg.answer("⏳ PIN'lar yaratilmoqda...")
     
-    pins = []
     batch_id = str(ObjectId())
+    created_by = msg.from_user.id if hasattr(msg, 'from_user') else msg.chat.id
     
     try:
-        for i in range(data['pin_count']):
-            pin = generate_pin()
-            pin_doc = {
+        # To'plam hujjati birinchi - PIN'lar hech qachon egasiz qolmaydi (xato bo'lsa hammasi o'chiriladi)
+        batch_info = {
+            "batch_id": batch_id,
+            "batch_no": await next_id("batch"),
+            "grade": data['grade'],
+            "topic": data['topic'],
+            "pin_count": data['pin_count'],
+            "question_count": DEFAULT_QUESTION_COUNT,
+            "time_limit": DEFAULT_TIME_LIMIT,
+            "multi_use": data.get('multi_use', False),
+            "max_attempts": data.get('max_attempts', 1),
+            "expiry_days": PIN_EXPIRY_DAYS,
+            "created_by": created_by,
+            "created_at": datetime.now(),
+            "status": "creating"
+        }
+        await pin_batches_col.insert_one(batch_info)
+        
+        # Bo'laklab yozish - katta to'plam ham xotirada bir bo'lakdan ortiq turmaydi
+        for start in range(0, data['pin_count'], PIN_INSERT_CHUNK):
+            numbers = range(start, min(start + PIN_INSERT_CHUNK, data['pin_count']))
+            docs = [{
                 "pin": pin,
                 "batch_id": batch_id,
                 "number": i + 1,
                 "grade": data['grade'],
                 "topic": data['topic'],
-                "created_by": msg.from_user.id if hasattr(msg, 'from_user') else msg.chat.id,
+                "created_by": created_by,
                 "created_at": datetime.now(),
                 "expires_at": datetime.now() + timedelta(days=PIN_EXPIRY_DAYS),
                 "active": True,
@@ -763,27 +2934,15 @@ async def create_batch_pins(msg: Message, state: FSMContext):
                 "used_by": [],
                 "question_count": DEFAULT_QUESTION_COUNT,
                 "time_limit": DEFAULT_TIME_LIMIT
-            }
-            await pins_col.insert_one(pin_doc)
-            pins.append(pin_doc)
+            } for i, pin in zip(numbers, await allocate_pins(len(numbers)))]
+            await insert_pins(docs)
+            if data['pin_count'] > PIN_INSERT_CHUNK:
+                await status.edit_text(f"⏳ PIN'lar yaratilmoqda: {start + len(docs)}/{data['pin_count']}")
         
-        batch_info = {
-            "batch_id": batch_id,
-            "grade": data['grade'],
-            "topic": data['topic'],
-            "pin_count": data['pin_count'],
-            "question_count": DEFAULT_QUESTION_COUNT,
-            "time_limit": DEFAULT_TIME_LIMIT,
-            "multi_use": data.get('multi_use', False),
-            "max_attempts": data.get('max_attempts', 1),
-            "expiry_days": PIN_EXPIRY_DAYS,
-            "created_by": msg.from_user.id if hasattr(msg, 'from_user') else msg.chat.id,
-            "created_at": datetime.now()
-        }
-        await pin_batches_col.insert_one(batch_info)
-        
-        pdf_data = generate_pins_pdf(pins, batch_info)
-        json_data = generate_pins_json(pins, batch_info)
+        await pin_batches_col.update_one({"batch_id": batch_id}, {"$unset": {"status": ""}})
+        del batch_info["status"]
+        await build_test_forms(batch_id, data['grade'], data['topic'], DEFAULT_QUESTION_COUNT,
+                               datetime.now() + timedelta(days=PIN_EXPIRY_DAYS))
         
         await status.delete()
         
@@ -795,22 +2954,19 @@ async def create_batch_pins(msg: Message, state: FSMContext):
             f"📚 {data['grade']}-sinf | {data['topic']}\n"
             f"🔄 {multi_text} {attempts_info}"
         )
-        
-        filename = data['topic'].replace('/', '-')[:30]
-        await msg.answer_document(
-            BufferedInputFile(pdf_data, f"PIN_{data['grade']}_{filename}.pdf"),
-            caption="📄 PDF format - chop etish uchun"
-        )
-        await msg.answer_document(
-            BufferedInputFile(json_data.encode('utf-8'), f"PIN_{data['grade']}_{filename}.json"),
-            caption="💾 JSON format"
-        )
+        await send_batch_files(msg, batch_info)
         
         await state.clear()
         
     except Exception as e:
+        log.exception("PIN creation error")
+        try:
+            if await pin_batches_col.count_documents({"batch_id": batch_id, "status": "creating"}):
+                await pins_col.delete_many({"batch_id": batch_id})
+                await pin_batches_col.delete_one({"batch_id": batch_id})
+        except Exception:
+            log.exception("Yarim yaratilgan to'plamni o'chirish xatosi (%s)", batch_id)
         await status.edit_text(f"❌ Xatolik: {e}")
-        print(f"PIN creation error: {e}")
         await state.clear()
 
 
@@ -820,7 +2976,7 @@ async def pin_mgmt(msg: Message):
     if msg.from_user.id not in ADMIN_IDS: return
     await msg.answer("PIN boshqaruv:", reply_markup=pin_management_kb())
 
-@router.callback_query(F.data == "pinmgmt_list")
+@callbacks.on("pinmgmt_list")
 async def pin_list(cb: CallbackQuery):
     batches = await pin_batches_col.find().sort("created_at", -1).limit(10).to_list(10)
     if not batches:
@@ -830,30 +2986,61 @@ async def pin_list(cb: CallbackQuery):
     text = "📋 PIN to'plamlari:\n\n"
     for i, b in enumerate(batches, 1):
         used = await pins_col.count_documents({"batch_id": b['batch_id'], "used_count": {"$gt": 0}})
-        text += f"{i}. {b['grade']}-sinf | {b['topic'][:20]}\n   {used}/{b['pin_count']}\n\n"
+        mark = " ⚠️ to'liq yaratilmagan" if b.get('status') == "creating" else ""
+        text += f"{i}. {b['grade']}-sinf | {b['topic'][:20]}{mark}\n   {used}/{b['pin_count']}\n\n"
+        if 'batch_no' not in b:  # backfill'dan keyin qo'shilgan eski to'plam
+            b['batch_no'] = await assign_batch_no(b)
     
-    btns = [[InlineKeyboardButton(text=f"{b['grade']}-sinf {b['topic'][:15]}", callback_data=f"pinbatch_{b['batch_id']}")] for b in batches]
+    btns = [[InlineKeyboardButton(text=f"{b['grade']}-sinf {b['topic'][:15]}",
+                                  callback_data=PinBatchCb(batch=b['batch_no']).pack())] for b in batches]
     await cb.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=btns))
 
-@router.callback_query(F.data.startswith("pinbatch_"))
-async def pin_batch(cb: CallbackQuery):
-    batch_id = cb.data.replace("pinbatch_", "")
-    batch = await pin_batches_col.find_one({"batch_id": batch_id})
+@callbacks.on(PinBatchCb)
+async def pin_batch(cb: CallbackQuery, callback_data: PinBatchCb):
+    batch = await pin_batches_col.find_one({"batch_no": callback_data.batch})
     if not batch:
         await cb.answer("❌ Topilmadi!")
         return
     
-    pins = await pins_col.find({"batch_id": batch_id}).to_list(200)
-    pdf_data = generate_pins_pdf(pins, batch)
-    json_data = generate_pins_json(pins, batch)
-    
-    await cb.message.answer(f"📋 {batch['grade']}-sinf | {batch['topic']}\n{len(pins)} ta PIN")
+    await cb.message.answer(
+        f"📋 {batch['grade']}-sinf | {batch['topic']}\n{batch['pin_count']} ta PIN",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+            text="📡 Jonli panel", callback_data=DashCb(batch=callback_data.batch).pack()
+        )]])
+    )
+    await send_batch_files(cb.message, batch)
+
+@callbacks.on(DashCb)
+async def open_dashboard(cb: CallbackQuery, callback_data: DashCb):
+    """To'plam uchun jonli panel xabari (qadab qo'yiladi); qayta bosilsa - yangi xabar"""
+    batch = await pin_batches_col.find_one({"batch_no": callback_data.batch})
+    if not batch:
+        await cb.answer("❌ Topilmadi!")
+        return
     
-    filename = batch['topic'].replace('/', '-')[:30]
-    await cb.message.answer_document(BufferedInputFile(pdf_data, f"PIN_{filename}.pdf"), caption="📄 PDF")
-    await cb.message.answer_document(BufferedInputFile(json_data.encode('utf-8'), f"PIN_{filename}.json"), caption="💾 JSON")
+    chat_id = cb.message.chat.id
+    doc = {
+        "_id": batch['batch_id'],
+        "grade": batch['grade'],
+        "topic": batch['topic'],
+        "pin_count": batch['pin_count'],
+        "chat_id": chat_id,
+        "shard": chat_id % WORKERS,
+        **await batch_totals(batch['batch_id']),
+        "dirty": False,
+        "expires_at": batch['created_at'] + timedelta(days=batch.get('expiry_days', PIN_EXPIRY_DAYS))
+    }
+    panel = await cb.message.answer(dashboard_text(doc), parse_mode="HTML")
+    doc["message_id"] = panel.message_id
+    await dashboards_col.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+    dashboard_hub.opened(doc["_id"], chat_id)
+    try:
+        await bot.pin_chat_message(chat_id, panel.message_id, disable_notification=True)
+    except Exception:
+        pass
+    await cb.answer()
 
-@router.callback_query(F.data == "pinmgmt_reset")
+@callbacks.on("pinmgmt_reset")
 async def pin_reset(cb: CallbackQuery, state: FSMContext):
     await cb.message.edit_text("🔄 PIN kodni kiriting:")
     await state.set_state(AdminStates.pin_reset_select)
@@ -867,10 +3054,11 @@ async def pin_reset_do(msg: Message, state: FSMContext):
         return
     
     await pins_col.update_one({"pin": pin}, {"$set": {"used_count": 0, "used_by": [], "active": True}})
+    pin_cache.invalidate(pin)
     await msg.answer(f"✅ Reset: {pin}")
     await state.clear()
 
-@router.callback_query(F.data == "pinmgmt_stats")
+@callbacks.on("pinmgmt_stats")
 async def pin_stats(cb: CallbackQuery):
     total = await pins_col.count_documents({})
     active = await pins_col.count_documents({"active": True, "expires_at": {"$gt": datetime.now()}})
@@ -883,24 +3071,52 @@ async def test_start(msg: Message, state: FSMContext):
     await msg.answer("🔑 PIN kod:", reply_markup=ReplyKeyboardRemove())
     await state.set_state(StudentStates.waiting_pin)
 
-@router.message(StudentStates.waiting_pin)
-async def test_pin(msg: Message, state: FSMContext):
-    pin = msg.text.strip()
-    pin_data = await pins_col.find_one({"pin": pin, "active": True, "expires_at": {"$gt": datetime.now()}})
+async def check_pin(pin: str, user_id: int) -> tuple:
+    """PIN'ni tekshirish: (pin_data, None) yoki (None, xato matni)"""
+    wait = pin_cache.throttled(user_id)
+    if wait:
+        return None, f"⏳ Juda ko'p noto'g'ri urinish. {wait} soniyadan keyin qayta kiriting."
+    
+    pin_data = None
+    if pin.isdigit() and len(pin) == 8:  # formatga mos kelmasa bazaga murojaat qilinmaydi
+        pin_data = pin_cache.get(pin)
+        if pin_data is None:
+            pin_data = await pins_col.find_one({"pin": pin, "active": True, "expires_at": {"$gt": datetime.now()}})
+            pin_cache.put(pin, pin_data)
     
     if not pin_data:
-        await msg.answer("❌ PIN noto'g'ri!")
-        return
+        pin_cache.fail(user_id)
+        return None, "❌ PIN noto'g'ri!"
     
     if not pin_data.get('multi_use', False):
-        if msg.from_user.id in pin_data.get('used_by', []):
-            await msg.answer("❌ Siz bu testni ishlagansiz!")
-            return
+        if user_id in pin_data.get('used_by', []):
+            return None, "❌ Siz bu testni ishlagansiz!"
     else:
-        attempts = pin_data.get('used_by', []).count(msg.from_user.id)
+        attempts = pin_data.get('used_by', []).count(user_id)
         if attempts >= pin_data.get('max_attempts', 999):
-            await msg.answer(f"❌ {attempts} marta ishlagansiz!")
-            return
+            return None, f"❌ {attempts} marta ishlagansiz!"
+    return pin_data, None
+
+async def start_with_pin(msg: Message, state: FSMContext, pin: str):
+    if await state.get_state() == StudentStates.taking_test.state:
+        await msg.answer("❌ Avval joriy testni yakunlang!")
+        return
+    await register_user(msg)
+    pin_data, error = await check_pin(pin, msg.from_user.id)
+    if error:
+        await msg.answer(error, reply_markup=student_menu())
+        return
+    await state.update_data(pin_data=pin_data)
+    await msg.answer(f"🔑 PIN: {pin}\n📚 {pin_data['grade']}-sinf | {pin_data['topic']}\n\n👤 Ism-familiya:",
+                     reply_markup=ReplyKeyboardRemove())
+    await state.set_state(StudentStates.waiting_name)
+
+@router.message(StudentStates.waiting_pin)
+async def test_pin(msg: Message, state: FSMContext):
+    pin_data, error = await check_pin(msg.text.strip(), msg.from_user.id)
+    if error:
+        await msg.answer(error)
+        return
     
     await state.update_data(pin_data=pin_data)
     await msg.answer("👤 Ism-familiya:")
@@ -916,39 +3132,39 @@ async def test_name(msg: Message, state: FSMContext):
     data = await state.get_data()
     pin_data = data['pin_data']
     
-    all_q = await questions_col.find({"grade": pin_data['grade'], "topic": pin_data['topic']}).to_list(200)
-    if not all_q:
-        await msg.answer("❌ Savollar yo'q!")
-        await state.clear()
-        return
-    
-    count = min(pin_data.get('question_count', 10), len(all_q))
-    selected = random.sample(all_q, count)
-    
-    for q in selected:
-        if q.get('options') and isinstance(q.get('answer'), int):
-            correct = q['options'][q['answer']]
-            random.shuffle(q['options'])
-            q['answer'] = q['options'].index(correct)
+    # Oldindan tuzilgan variant (bitta o'qish); yo'q bo'lsa - eski usul
+    forms = await test_forms_col.find_one({"_id": pin_data.get('batch_id')}) if pin_data.get('batch_id') else None
+    if forms:
+        questions = form_questions(forms)
+    else:
+        all_q = await questions_col.find({"grade": pin_data['grade'], "topic": pin_data['topic'], **VISIBLE}).to_list(200)
+        if not all_q:
+            await msg.answer("❌ Savollar yo'q!")
+            await state.clear()
+            return
+        
+        selected = random.sample(all_q, min(pin_data.get('question_count', 10), len(all_q)))
+        for q in selected:
+            if q.get('options') and isinstance(q.get('answer'), int):
+                correct = q['options'][q['answer']]
+                random.shuffle(q['options'])
+                q['answer'] = q['options'].index(correct)
+        questions = [session_question(q) for q in selected]
+    count = len(questions)
     
     # Unique ID
     test_id = str(ObjectId())
+    log_test_id.set(test_id)
     
     session = {
         "test_id": test_id,
         "user_id": msg.from_user.id,
         "user_name": name,
         "pin": pin_data['pin'],
+        "batch_id": pin_data.get('batch_id'),
         "grade": pin_data['grade'],
         "topic": pin_data['topic'],
-        "questions": [{
-            'id': str(q['_id']),
-            'text': q['text'],
-            'options': q.get('options', []),
-            'answer': q['answer'],
-            'type': q.get('type', 'choice'),
-            'images': q.get('images', [])
-        } for q in selected],
+        "questions": questions,
         "answers": {},
         "current": 0,
         "started_at": datetime.now(),
@@ -956,6 +3172,8 @@ async def test_name(msg: Message, state: FSMContext):
     }
     
     await state.update_data(session=session)
+    await schedule_timer(session, msg.chat.id)
+    events.publish("test_started", batch_id=session['batch_id'])
     await msg.answer(
         f"📝 Test: {name}\n"
         f"{pin_data['grade']}-sinf | {pin_data['topic']}\n"
@@ -971,7 +3189,7 @@ async def delete_questions_menu(msg: Message):
     if msg.from_user.id not in ADMIN_IDS:
         return
     
-    total_q = await questions_col.count_documents({})
+    total_q = await questions_col.count_documents(VISIBLE)
     
     await msg.answer(
         f"🗑 <b>Savollarni o'chirish</b>\n\n"
@@ -981,7 +3199,7 @@ async def delete_questions_menu(msg: Message):
         reply_markup=delete_questions_kb()
     )
 
-@router.callback_query(F.data == "delq_by_grade")
+@callbacks.on("delq_by_grade")
 async def delete_by_grade_start(cb: CallbackQuery, state: FSMContext):
     await cb.message.edit_text(
         "📚 Qaysi sinf savollarini o'chirmoqchisiz?",
@@ -989,10 +3207,10 @@ async def delete_by_grade_start(cb: CallbackQuery, state: FSMContext):
     )
     await state.set_state(AdminStates.delete_by_grade)
 
-@router.callback_query(AdminStates.delete_by_grade, F.data.startswith("grade_"))
-async def delete_by_grade_confirm(cb: CallbackQuery, state: FSMContext):
-    grade = int(cb.data.split("_")[1])
-    count = await questions_col.count_documents({"grade": grade})
+@callbacks.on(GradeCb, state=AdminStates.delete_by_grade)
+async def delete_by_grade_confirm(cb: CallbackQuery, state: FSMContext, callback_data: GradeCb):
+    grade = callback_data.grade
+    count = await questions_col.count_documents({"grade": grade, **VISIBLE})
     
     if count == 0:
         await cb.message.edit_text(f"❌ {grade}-sinf uchun savollar yo'q!")
@@ -1016,12 +3234,12 @@ async def delete_by_grade_confirm(cb: CallbackQuery, state: FSMContext):
         reply_markup=confirm_kb
     )
 
-@router.callback_query(F.data == "confirm_delete_grade")
+@callbacks.on("confirm_delete_grade")
 async def delete_by_grade_execute(cb: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     grade = data['delete_grade']
     
-    result = await questions_col.delete_many({"grade": grade})
+    result = await questions_col.delete_many({"grade": grade, **VISIBLE})
     
     await cb.message.edit_text(
         f"✅ {result.deleted_count} ta savol o'chirildi!\n"
@@ -1029,16 +3247,21 @@ async def delete_by_grade_execute(cb: CallbackQuery, state: FSMContext):
     )
     await state.clear()
 
-@router.callback_query(F.data == "delq_by_topic")
+@callbacks.on("delq_by_topic")
 async def delete_by_topic_start(cb: CallbackQuery, state: FSMContext):
     await cb.message.edit_text("📚 Avval sinfni tanlang:", reply_markup=grade_kb())
     await state.set_state(AdminStates.delete_by_topic)
     await state.update_data(delete_step="grade")
 
-@router.callback_query(AdminStates.delete_by_topic, F.data.startswith("grade_"))
-async def delete_by_topic_grade(cb: CallbackQuery, state: FSMContext):
-    grade = int(cb.data.split("_")[1])
-    topics = await questions_col.distinct("topic", {"grade": grade})
+@callbacks.on(GradeCb, state=AdminStates.delete_by_topic)
+async def delete_by_topic_grade(cb: CallbackQuery, state: FSMContext, callback_data: GradeCb):
+    grade = callback_data.grade
+    # Mavzular va savollar soni bitta so'rovda
+    topics = await questions_col.aggregate([
+        {"$match": {"grade": grade, **VISIBLE}},
+        {"$group": {"_id": "$topic", "count": {"$sum": 1}}},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
     
     if not topics:
         await cb.message.edit_text(f"❌ {grade}-sinf uchun mavzular yo'q!")
@@ -1048,11 +3271,10 @@ async def delete_by_topic_grade(cb: CallbackQuery, state: FSMContext):
     await state.update_data(delete_grade=grade)
     
     btns = []
-    for topic in topics:
-        count = await questions_col.count_documents({"grade": grade, "topic": topic})
+    for t in topics:
         btns.append([InlineKeyboardButton(
-            text=f"{topic} ({count} ta)",
-            callback_data=f"deltopic_{topic}"
+            text=f"{t['_id']} ({t['count']} ta)",
+            callback_data=DelTopicCb(topic=await topic_registry.id_for(t['_id'])).pack()
         )])
     
     await cb.message.edit_text(
@@ -1060,13 +3282,16 @@ async def delete_by_topic_grade(cb: CallbackQuery, state: FSMContext):
         reply_markup=InlineKeyboardMarkup(inline_keyboard=btns)
     )
 
-@router.callback_query(AdminStates.delete_by_topic, F.data.startswith("deltopic_"))
-async def delete_by_topic_confirm(cb: CallbackQuery, state: FSMContext):
-    topic = cb.data.replace("deltopic_", "")
+@callbacks.on(DelTopicCb, state=AdminStates.delete_by_topic)
+async def delete_by_topic_confirm(cb: CallbackQuery, state: FSMContext, callback_data: DelTopicCb):
+    topic = await topic_registry.name_for(callback_data.topic)
+    if topic is None:
+        await cb.answer("❌ Topilmadi!")
+        return
     data = await state.get_data()
     grade = data['delete_grade']
     
-    count = await questions_col.count_documents({"grade": grade, "topic": topic})
+    count = await questions_col.count_documents({"grade": grade, "topic": topic, **VISIBLE})
     
     await state.update_data(delete_topic=topic, delete_count=count)
     
@@ -1087,13 +3312,13 @@ async def delete_by_topic_confirm(cb: CallbackQuery, state: FSMContext):
         reply_markup=confirm_kb
     )
 
-@router.callback_query(F.data == "confirm_delete_topic")
+@callbacks.on("confirm_delete_topic")
 async def delete_by_topic_execute(cb: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     grade = data['delete_grade']
     topic = data['delete_topic']
     
-    result = await questions_col.delete_many({"grade": grade, "topic": topic})
+    result = await questions_col.delete_many({"grade": grade, "topic": topic, **VISIBLE})
     
     await cb.message.edit_text(
         f"✅ {result.deleted_count} ta savol o'chirildi!\n"
@@ -1101,14 +3326,14 @@ async def delete_by_topic_execute(cb: CallbackQuery, state: FSMContext):
     )
     await state.clear()
 
-@router.callback_query(F.data == "delq_individual")
+@callbacks.on("delq_individual")
 async def delete_individual_start(cb: CallbackQuery):
     await cb.message.edit_text("Sinfni tanlang:", reply_markup=grade_kb())
     # Bu qism oldingi "O'chirish" funksiyasiga o'xshash
 
-@router.callback_query(F.data == "delq_all")
+@callbacks.on("delq_all")
 async def delete_all_confirm(cb: CallbackQuery, state: FSMContext):
-    total = await questions_col.count_documents({})
+    total = await questions_col.count_documents(VISIBLE)
     
     confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⚠️ Barcha savollarni o'chirish", callback_data="confirm_delete_all")],
@@ -1124,9 +3349,9 @@ async def delete_all_confirm(cb: CallbackQuery, state: FSMContext):
         reply_markup=confirm_kb
     )
 
-@router.callback_query(F.data == "confirm_delete_all")
+@callbacks.on("confirm_delete_all")
 async def delete_all_execute(cb: CallbackQuery):
-    result = await questions_col.delete_many({})
+    result = await questions_col.delete_many(VISIBLE)
     
     await cb.message.edit_text(f"✅ Barcha {result.deleted_count} ta savol o'chirildi!")
 
@@ -1147,94 +3372,92 @@ async def results_menu(msg: Message, state: FSMContext):
     )
     await state.set_state(TeacherStates.waiting_pin_for_report)
 
+def report_query(query_type: str) -> tuple:
+    """(filter, limit) - PIN yoki all/today/week"""
+    if query_type == 'all':
+        return {}, 100
+    if query_type == 'today':
+        today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        return {"completed_at": {"$gte": today_start}}, 100
+    if query_type == 'week':
+        return {"completed_at": {"$gte": datetime.now() - timedelta(days=7)}}, 200
+    return {"pin": query_type}, 100
+
+async def report_watermark(query: dict, limit: int) -> tuple:
+    """(oxirgi completed_at, natijalar soni) - hisobot kesh kaliti uchun, natijalarni yuklamasdan"""
+    latest, count = await asyncio.gather(
+        results_col.find_one(query, {"completed_at": 1}, sort=[("completed_at", -1)]),
+        results_col.count_documents(query, limit=limit)
+    )
+    return (latest or {}).get("completed_at"), count
+
 @router.message(TeacherStates.waiting_pin_for_report)
 async def results_pin_entered(msg: Message, state: FSMContext):
     pin = msg.text.strip().lower()
+    _, count = await report_watermark(*report_query(pin))
     
-    # Query yaratish
-    if pin == 'all':
-        query = {}
-        limit = 100
-    elif pin == 'today':
-        today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        query = {"completed_at": {"$gte": today_start}}
-        limit = 100
-    elif pin == 'week':
-        week_ago = datetime.now() - timedelta(days=7)
-        query = {"completed_at": {"$gte": week_ago}}
-        limit = 200
-    else:
-        query = {"pin": pin}
-        limit = 100
-    
-    results = await results_col.find(query).sort("completed_at", -1).limit(limit).to_list(limit)
-    
-    if not results:
+    if not count:
         await msg.answer("❌ Natijalar topilmadi!")
         await state.clear()
         return
     
-    await state.update_data(results=results, query_type=pin)
+    # Natijalarning o'zi FSM'ga yozilmaydi - hisobot tanlanganda (kesh bo'lmasa) qayta o'qiladi
+    await state.update_data(query_type=pin)
     
     await msg.answer(
-        f"✅ {len(results)} ta natija topildi!\n\n"
+        f"✅ {count} ta natija topildi!\n\n"
         f"Hisobot turini tanlang:",
         reply_markup=report_type_kb()
     )
     await state.set_state(TeacherStates.selecting_report_type)
 
-@router.callback_query(TeacherStates.selecting_report_type, F.data.startswith("report_"))
+@callbacks.on("report_", state=TeacherStates.selecting_report_type)
 async def generate_report(cb: CallbackQuery, state: FSMContext):
     report_type = cb.data.replace("report_", "")
     data = await state.get_data()
-    results = data['results']
     query_type = data.get('query_type', 'unknown')
+    query, limit = report_query(query_type)
     
     status = await cb.message.edit_text("⏳ PDF yaratilmoqda...")
     
     try:
+        watermark, count = await report_watermark(query, limit)
+        results = None
+        
+        def report(kind: str, generate, filename: str) -> tuple:
+            # Fayl nomi kalitda: file_id bilan qayta yuborilganda ham nom so'ralgani bilan bir xil
+            return artifact_key(kind, query_type, watermark, count, filename), builder(generate), filename
+        
+        def builder(generate):
+            async def build():
+                nonlocal results
+                if results is None:
+                    results = await results_col.find(query).sort("completed_at", -1).limit(limit).to_list(limit)
+                return await asyncio.to_thread(generate, results)
+            return build
+        
         if report_type == "summary":
-            pdf_data = generate_summary_report(results)
-            filename = f"Qisqacha_Hisobot_{query_type}_{datetime.now().strftime('%d%m%Y')}.pdf"
-            caption = f"📄 Qisqacha hisobot - {len(results)} ta natija"
-            
+            caption = f"📄 Qisqacha hisobot - {count} ta natija"
+            await send_artifact(cb.message, *report("summary", generate_summary_report,
+                                                    f"Qisqacha_Hisobot_{query_type}.pdf"), caption)
             await status.delete()
-            await cb.message.answer_document(
-                BufferedInputFile(pdf_data, filename),
-                caption=caption
-            )
         
         elif report_type == "detailed":
-            pdf_data = generate_detailed_student_report(results)
-            filename = f"Batafsil_Hisobot_{query_type}_{datetime.now().strftime('%d%m%Y')}.pdf"
-            caption = f"📋 Batafsil hisobot - {len(results)} ta natija\n\nHar bir o'quvchi uchun alohida ma'lumotlar"
-            
+            caption = f"📋 Batafsil hisobot - {count} ta natija\n\nHar bir o'quvchi uchun alohida ma'lumotlar"
+            await send_artifact(cb.message, *report("detailed", generate_detailed_student_report,
+                                                    f"Batafsil_Hisobot_{query_type}.pdf"), caption)
             await status.delete()
-            await cb.message.answer_document(
-                BufferedInputFile(pdf_data, filename),
-                caption=caption
-            )
         
         elif report_type == "both":
-            # Qisqacha
-            pdf_summary = generate_summary_report(results)
-            await cb.message.answer_document(
-                BufferedInputFile(pdf_summary, f"Qisqacha_{query_type}.pdf"),
-                caption="📄 Qisqacha hisobot"
-            )
-            
-            # Batafsil
-            pdf_detailed = generate_detailed_student_report(results)
-            await cb.message.answer_document(
-                BufferedInputFile(pdf_detailed, f"Batafsil_{query_type}.pdf"),
-                caption="📋 Batafsil hisobot"
-            )
-            
+            await send_artifact(cb.message, *report("summary", generate_summary_report, f"Qisqacha_{query_type}.pdf"),
+                                "📄 Qisqacha hisobot")
+            await send_artifact(cb.message, *report("detailed", generate_detailed_student_report,
+                                                    f"Batafsil_{query_type}.pdf"), "📋 Batafsil hisobot")
             await status.delete()
     
     except Exception as e:
         await status.edit_text(f"❌ Xatolik: {e}")
-        print(f"PDF generation error: {e}")
+        log.exception("PDF generation error")
     
     await state.clear()
 
@@ -1245,7 +3468,7 @@ async def settings_menu(msg: Message):
     if msg.from_user.id not in ADMIN_IDS:
         return
     
-    total_q = await questions_col.count_documents({})
+    total_q = await questions_col.count_documents(VISIBLE)
     total_r = await results_col.count_documents({})
     total_p = await pins_col.count_documents({})
     total_img = await images_col.count_documents({})
@@ -1276,12 +3499,13 @@ async def settings_menu(msg: Message):
     settings_kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔄 Bazani tozalash", callback_data="clean_db")],
         [InlineKeyboardButton(text="💾 Backup olish", callback_data="backup_db")],
+        [InlineKeyboardButton(text="♻️ Backupdan tiklash", callback_data="restore_db")],
         [InlineKeyboardButton(text="📊 To'liq statistika", callback_data="full_stats")]
     ])
     
     await msg.answer(settings_text, parse_mode="HTML", reply_markup=settings_kb)
 
-@router.callback_query(F.data == "clean_db")
+@callbacks.on("clean_db")
 async def clean_database(cb: CallbackQuery):
     # Muddati o'tgan PIN'larni o'chirish
     result = await pins_col.delete_many({"expires_at": {"$lt": datetime.now()}})
@@ -1292,10 +3516,58 @@ async def clean_database(cb: CallbackQuery):
     
     await cb.answer(f"✅ Tozalandi! PIN: {result.deleted_count}, Natijalar: {old_results.deleted_count}", show_alert=True)
 
-@router.callback_query(F.data == "full_stats")
+@callbacks.on("backup_db")
+async def backup_database(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS: return
+    await cb.answer()
+    status = await cb.message.answer("⏳ Backup tayyorlanmoqda...")
+    path = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl.gz"
+    try:
+        counts = await export_backup(path)
+        await cb.message.answer_document(
+            FSInputFile(path),
+            caption=f"💾 Backup\n📝 Savollar: {counts['questions']}\n🖼 Rasmlar: {counts['images']}"
+        )
+        await status.delete()
+    except Exception as e:
+        log.exception("Backup xatosi")
+        await status.edit_text(f"❌ Xato: {e}")
+    finally:
+        if os.path.exists(path): os.remove(path)
+
+@callbacks.on("restore_db")
+async def restore_database(cb: CallbackQuery, state: FSMContext):
+    if cb.from_user.id not in ADMIN_IDS: return
+    await cb.message.answer("♻️ Backup faylni (.jsonl.gz) yuboring\n\n"
+                            "Mavjud savollar o'chirilmaydi, bir xillari takrorlanmaydi.")
+    await state.set_state(AdminStates.waiting_backup)
+    await cb.answer()
+
+@router.message(AdminStates.waiting_backup, F.document)
+async def restore_file(msg: Message, state: FSMContext):
+    if msg.from_user.id not in ADMIN_IDS: return
+    if not msg.document.file_name.endswith('.jsonl.gz'):
+        await msg.answer("❌ Faqat .jsonl.gz!"); return
+    await state.clear()
+    status = await msg.answer("⏳ Backup tiklanmoqda...")
+    path = f"restore_{msg.from_user.id}.jsonl.gz"
+    try:
+        file = await bot.get_file(msg.document.file_id)
+        await bot.download_file(file.file_path, path)
+        counts = await import_backup(path)
+        await status.edit_text(f"✅ Backup tiklandi!\n\n{ingest_report(counts)}\n"
+                               f"🖼 Yangi rasmlar: {counts['images_new']}, mavjudlari: {counts['images_dup']}")
+    except Exception as e:
+        log.exception("Backup tiklash xatosi")
+        await status.edit_text(f"❌ Xato: {e}")
+    finally:
+        if os.path.exists(path): os.remove(path)
+
+@callbacks.on("full_stats")
 async def full_statistics(cb: CallbackQuery):
     # Sinf bo'yicha
     grades_pipeline = [
+        {"$match": VISIBLE},
         {"$group": {"_id": "$grade", "count": {"$sum": 1}}},
         {"$sort": {"_id": 1}}
     ]
@@ -1303,6 +3575,7 @@ async def full_statistics(cb: CallbackQuery):
     
     # Qiyinlik bo'yicha
     diff_pipeline = [
+        {"$match": VISIBLE},
         {"$group": {"_id": "$difficulty", "count": {"$sum": 1}}}
     ]
     difficulties = await questions_col.aggregate(diff_pipeline).to_list(10)
@@ -1354,7 +3627,7 @@ async def send_question(msg: Message, state: FSMContext, q_index: int):
     
     # Rasmlarni yuborish
     if q.get('images'):
-        print(f"Savol {q_index+1} da {len(q['images'])} ta rasm bor")
+        log.debug("Savol %d da %d ta rasm bor", q_index + 1, len(q['images']), extra={"sampled": True})
         for img_id in q['images']:
             img_data = await get_image(img_id)
             if img_data:
@@ -1363,11 +3636,11 @@ async def send_question(msg: Message, state: FSMContext, q_index: int):
                         BufferedInputFile(img_data, "question.jpg"),
                         caption=f"📷 Savol {q_index+1}"
                     )
-                    print(f"✓ Rasm yuborildi: {img_id}")
+                    log.debug("Rasm yuborildi: %s", img_id, extra={"sampled": True})
                 except Exception as e:
-                    print(f"✗ Rasm yuborishda xato: {e}")
+                    log.warning("Rasm yuborishda xato (%s): %s", img_id, e)
             else:
-                print(f"✗ Rasm topilmadi: {img_id}")
+                log.warning("Rasm topilmadi: %s", img_id)
     
     # Javob klaviaturasi
     if q['type'] == 'choice' and q.get('options'):
@@ -1382,7 +3655,7 @@ async def send_question(msg: Message, state: FSMContext, q_index: int):
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(
                 text=f"{chr(65+i)}) {opt[:40]}{'...' if len(opt)>40 else ''}",
-                callback_data=f"ans_{s['test_id']}_{q_index}_{i}"
+                callback_data=AnsCb(test_id=s['test_id'], q=q_index, a=i).pack()
             )] for i, opt in enumerate(q['options'])
         ])
         
@@ -1396,120 +3669,18 @@ async def send_question(msg: Message, state: FSMContext, q_index: int):
     await msg.answer("📍 <b>Navigatsiya:</b>", parse_mode="HTML", reply_markup=nav_kb)
 
 
-def generate_detailed_student_report(results: List[dict]) -> bytes:
-    """Har bir o'quvchi uchun batafsil hisobot"""
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=1.5*cm, bottomMargin=1.5*cm)
-    elements = []
-    styles = getSampleStyleSheet()
-    
-    # Title
-    title_style = ParagraphStyle(
-        'Title',
-        parent=styles['Heading1'],
-        fontSize=18,
-        alignment=1,
-        spaceAfter=20,
-        textColor=colors.HexColor('#1a5f7a')
-    )
-    elements.append(Paragraph("📊 BATAFSIL TEST NATIJALARI", title_style))
-    elements.append(Spacer(1, 0.5*cm))
-    
-    # Umumiy statistika
-    total_students = len(results)
-    avg_score = sum(r['score'] for r in results) / total_students if total_students > 0 else 0
-    avg_time = sum(r['time_seconds'] for r in results) / total_students if total_students > 0 else 0
-    
-    summary_style = ParagraphStyle('Summary', parent=styles['Normal'], fontSize=10, spaceAfter=8)
-    elements.append(Paragraph(f"<b>Jami o'quvchilar:</b> {total_students}", summary_style))
-    elements.append(Paragraph(f"<b>O'rtacha ball:</b> {avg_score:.1f}%", summary_style))
-    elements.append(Paragraph(f"<b>O'rtacha vaqt:</b> {int(avg_time//60)}:{int(avg_time%60):02d}", summary_style))
-    elements.append(Paragraph(f"<b>Sana:</b> {datetime.now().strftime('%d.%m.%Y %H:%M')}", summary_style))
-    elements.append(Spacer(1, 1*cm))
-    
-    # Har bir o'quvchi uchun
-    for idx, result in enumerate(results, 1):
-        # O'quvchi ma'lumotlari
-        student_style = ParagraphStyle('Student', parent=styles['Heading2'], fontSize=14, textColor=colors.HexColor('#2c5f2d'))
-        elements.append(Paragraph(f"{idx}. {result['user_name']}", student_style))
-        
-        info_style = ParagraphStyle('Info', parent=styles['Normal'], fontSize=9, spaceAfter=4)
-        elements.append(Paragraph(f"📚 <b>Sinf:</b> {result['grade']}", info_style))
-        elements.append(Paragraph(f"📝 <b>Mavzu:</b> {result['topic']}", info_style))
-        elements.append(Paragraph(f"📊 <b>Ball:</b> {result['score']}% ({result['correct']}/{result['total']})", info_style))
-        
-        minutes = int(result['time_seconds'] // 60)
-        seconds = int(result['time_seconds'] % 60)
-        elements.append(Paragraph(f"⏱ <b>Vaqt:</b> {minutes}:{seconds:02d}", info_style))
-        elements.append(Paragraph(f"📅 <b>Sana:</b> {result['completed_at'].strftime('%d.%m.%Y %H:%M')}", info_style))
-        elements.append(Spacer(1, 0.3*cm))
-        
-        # Savollar jadvali
-        if result.get('details'):
-            table_data = [["№", "Savol", "O'quvchi javobi", "To'g'ri javob", "Natija"]]
-            
-            for i, detail in enumerate(result['details'], 1):
-                status = "✓" if detail.get('ok') else "✗"
-                status_color = colors.green if detail.get('ok') else colors.red
-                
-                # Javoblarni formatlash
-                user_ans = detail.get('user', 'Berilmagan')
-                if isinstance(user_ans, int):
-                    user_ans = chr(65 + user_ans)  # 0->A, 1->B, etc
-                
-                correct_ans = detail.get('correct', '-')
-                if isinstance(correct_ans, int):
-                    correct_ans = chr(65 + correct_ans)
-                
-                table_data.append([
-                    str(i),
-                    Paragraph(detail['q'][:80] + "...", styles['Normal']) if len(detail['q']) > 80 else detail['q'],
-                    str(user_ans),
-                    str(correct_ans),
-                    Paragraph(f"<font color='{status_color.hexval()}'>{status}</font>", styles['Normal'])
-                ])
-            
-            # Jadval yaratish
-            col_widths = [1*cm, 9*cm, 2.5*cm, 2.5*cm, 1.5*cm]
-            table = Table(table_data, colWidths=col_widths)
-            table.setStyle(TableStyle([
-                # Header
-                ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4a5568')),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 9),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
-                # Body
-                ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-                ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                ('FONTSIZE', (0, 1), (-1, -1), 8),
-                ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f7fafc')]),
-                ('TOPPADDING', (0, 1), (-1, -1), 6),
-                ('BOTTOMPADDING', (0, 1), (-1, -1), 6),
-            ]))
-            
-            elements.append(table)
-        
-        elements.append(Spacer(1, 1*cm))
-        
-        # Sahifa uzilishi (oxirgi o'quvchidan tashqari)
-        if idx < len(results):
-            elements.append(Paragraph("<para align='center'>• • •</para>", styles['Normal']))
-            elements.append(Spacer(1, 0.5*cm))
-    
-    doc.build(elements)
-    buffer.seek(0)
-    return buffer.read()
-
-
 # ... (oldingi import va config bir xil) ...
 
 # ================= PDF GENERATION - YANGILANGAN =================
 
+@timed("cpu_seconds", func="generate_detailed_student_report")
 def generate_detailed_student_report(results: List[dict]) -> bytes:
     """Har bir o'quvchi uchun batafsil hisobot"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import cm
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=1.5*cm, bottomMargin=1.5*cm)
     elements = []
@@ -1615,8 +3786,14 @@ def generate_detailed_student_report(results: List[dict]) -> bytes:
     buffer.seek(0)
     return buffer.read()
 
+@timed("cpu_seconds", func="generate_summary_report")
 def generate_summary_report(results: List[dict]) -> bytes:
     """Qisqacha umumiy hisobot"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import cm
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm)
     elements = []
@@ -1695,13 +3872,12 @@ def generate_summary_report(results: List[dict]) -> bytes:
 
 
 
-@router.callback_query(F.data.startswith("ans_"))
-async def answer_selected(cb: CallbackQuery, state: FSMContext):
+@callbacks.on(AnsCb)
+async def answer_selected(cb: CallbackQuery, state: FSMContext, callback_data: AnsCb):
     """Javob tanlash"""
-    parts = cb.data.split("_")
-    test_id = parts[1]
-    q_index = int(parts[2])
-    answer = int(parts[3])
+    test_id = callback_data.test_id
+    q_index = callback_data.q
+    answer = callback_data.a
     
     data = await state.get_data()
     s = data.get('session', {})
@@ -1716,18 +3892,15 @@ async def answer_selected(cb: CallbackQuery, state: FSMContext):
     
     await cb.answer(f"✅ Javob saqlandi: {chr(65 + answer)}")
 
-@router.callback_query(F.data.startswith("nav_"))
-async def navigate(cb: CallbackQuery, state: FSMContext):
+@callbacks.on("nav_info")
+async def nav_info(cb: CallbackQuery):
+    await cb.answer("ℹ️ Savollarni tanlang yoki oldingi/keyingi tugmalaridan foydalaning")
+
+@callbacks.on(NavCb)
+async def navigate(cb: CallbackQuery, state: FSMContext, callback_data: NavCb):
     """Navigatsiya - TUZATILGAN"""
-    parts = cb.data.split("_")
-    
-    # nav_info uchun
-    if len(parts) < 3:
-        await cb.answer("ℹ️ Savollarni tanlang yoki oldingi/keyingi tugmalaridan foydalaning")
-        return
-    
-    test_id = parts[1]
-    direction = parts[2]
+    test_id = callback_data.test_id
+    direction = callback_data.direction
     
     data = await state.get_data()
     s = data.get('session', {})
@@ -1757,17 +3930,11 @@ async def navigate(cb: CallbackQuery, state: FSMContext):
     
     await send_question(cb.message, state, new_index)
 
-@router.callback_query(F.data.startswith("goto_"))
-async def goto_question(cb: CallbackQuery, state: FSMContext):
+@callbacks.on(GotoCb)
+async def goto_question(cb: CallbackQuery, state: FSMContext, callback_data: GotoCb):
     """Savolga o'tish - TUZATILGAN"""
-    parts = cb.data.split("_")
-    
-    if len(parts) < 3:
-        await cb.answer("❌ Xato!")
-        return
-    
-    test_id = parts[1]
-    q_index = int(parts[2])
+    test_id = callback_data.test_id
+    q_index = callback_data.q
     
     data = await state.get_data()
     s = data.get('session', {})
@@ -1786,50 +3953,10 @@ async def goto_question(cb: CallbackQuery, state: FSMContext):
     
     await send_question(cb.message, state, q_index)
 
-@router.callback_query(F.data.startswith("ans_"))
-async def answer_selected(cb: CallbackQuery, state: FSMContext):
-    """Javob tanlash - TUZATILGAN"""
-    parts = cb.data.split("_")
-    
-    if len(parts) < 4:
-        await cb.answer("❌ Xato!")
-        return
-    
-    test_id = parts[1]
-    q_index = int(parts[2])
-    answer = int(parts[3])
-    
-    data = await state.get_data()
-    s = data.get('session', {})
-    
-    if s.get('test_id') != test_id:
-        await cb.answer("❌ Eski test!")
-        return
-    
-    # Javobni saqlash
-    s['answers'][str(q_index)] = answer
-    await state.update_data(session=s)
-    
-    try:
-        await cb.message.edit_text(
-            cb.message.text + f"\n\n✅ <i>Javob saqlandi: {chr(65 + answer)}</i>",
-            parse_mode="HTML"
-        )
-    except:
-        pass
-    
-    await cb.answer(f"✅ Javob: {chr(65 + answer)}")
-
-@router.callback_query(F.data.startswith("finish_"))
-async def finish_confirm(cb: CallbackQuery, state: FSMContext):
+@callbacks.on(FinishCb)
+async def finish_confirm(cb: CallbackQuery, state: FSMContext, callback_data: FinishCb):
     """Testni yakunlash - TUZATILGAN"""
-    parts = cb.data.split("_")
-    
-    if len(parts) < 2:
-        await cb.answer("❌ Xato!")
-        return
-    
-    test_id = parts[1]
+    test_id = callback_data.test_id
     
     data = await state.get_data()
     s = data.get('session', {})
@@ -1853,20 +3980,20 @@ async def finish_confirm(cb: CallbackQuery, state: FSMContext):
         # Tasdiqlash klaviaturasi
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [
-                InlineKeyboardButton(text="✅ Ha, yakunla", callback_data=f"finishyes_{test_id}"),
-                InlineKeyboardButton(text="❌ Yo'q", callback_data=f"finishno_{test_id}")
+                InlineKeyboardButton(text="✅ Ha, yakunla", callback_data=FinishYesCb(test_id=test_id).pack()),
+                InlineKeyboardButton(text="❌ Yo'q", callback_data=FinishNoCb(test_id=test_id).pack())
             ]
         ])
         await cb.message.edit_reply_markup(reply_markup=kb)
     else:
         await finish_test(cb.message, state)
 
-@router.callback_query(F.data.startswith("finishyes_"))
+@callbacks.on(FinishYesCb)
 async def finish_yes(cb: CallbackQuery, state: FSMContext):
     await cb.answer("Test yakunlanmoqda...")
     await finish_test(cb.message, state)
 
-@router.callback_query(F.data.startswith("finishno_"))
+@callbacks.on(FinishNoCb)
 async def finish_no(cb: CallbackQuery, state: FSMContext):
     await cb.answer("Testni davom ettiring")
     data = await state.get_data()
@@ -1879,8 +4006,14 @@ async def finish_no(cb: CallbackQuery, state: FSMContext):
 
 async def finish_test(msg: Message, state: FSMContext):
     """Testni yakunlash"""
+    await finish_session(state, msg.chat.id)
+
+async def finish_session(state: FSMContext, chat_id: int):
+    """Natijani hisoblash va saqlash - tugma, taymer yoki admin tomonidan"""
     data = await state.get_data()
-    s = data['session']
+    s = data.get('session')
+    if not s:
+        return
     
     correct = sum(1 for i, q in enumerate(s['questions']) 
                   if s['answers'].get(str(i)) == q['answer'])
@@ -1893,6 +4026,7 @@ async def finish_test(msg: Message, state: FSMContext):
         "user_id": s['user_id'],
         "user_name": s['user_name'],
         "pin": s['pin'],
+        "batch_id": s.get('batch_id'),
         "grade": s['grade'],
         "topic": s['topic'],
         "score": score,
@@ -1906,11 +4040,17 @@ async def finish_test(msg: Message, state: FSMContext):
         {"pin": s['pin']},
         {"$push": {"used_by": s['user_id']}, "$inc": {"used_count": 1}}
     )
+    pin_cache.invalidate(s['pin'])
+    
+    await cancel_timer(s['test_id'])
+    events.publish("test_finished", batch_id=s.get('batch_id'), score=score)
+    log.info("Test yakunlandi", extra={"pin": s['pin'], "score": score, "correct": correct, "total": total})
     
     m, sec = int(time_sec // 60), int(time_sec % 60)
     emoji = "🏆" if score >= 86 else "🥈" if score >= 71 else "🥉" if score >= 56 else "📝"
     
-    await msg.answer(
+    await bot.send_message(
+        chat_id,
         f"{emoji} <b>Test yakunlandi!</b>\n\n"
         f"👤 {s['user_name']}\n"
         f"📚 {s['grade']}-sinf | {s['topic']}\n\n"
@@ -1921,9 +4061,10 @@ async def finish_test(msg: Message, state: FSMContext):
         reply_markup=student_menu()
     )
     
-    # Admin xabari
+    # Admin xabari - to'plam yaratuvchisining chatida jonli panel bo'lsa, natija o'sha yerda ko'rinadi
     pin_data = data.get('pin_data', {})
-    if admin_id := pin_data.get('created_by'):
+    admin_id = pin_data.get('created_by')
+    if admin_id and await dashboard_hub.panel_chat(s.get('batch_id')) != admin_id:
         try:
             await bot.send_message(
                 admin_id,
@@ -1935,38 +4076,131 @@ async def finish_test(msg: Message, state: FSMContext):
     await state.clear()
 
 # ===== RESULTS & STATS =====
-@router.message(F.text == "📊 Natijalar")
-async def results_menu(msg: Message, state: FSMContext):
-    if msg.from_user.id not in ADMIN_IDS: return
-    await msg.answer("PIN (yoki 'all'):")
-    await state.set_state(TeacherStates.waiting_pin_for_report)
-
-@router.message(TeacherStates.waiting_pin_for_report)
-async def results_gen(msg: Message, state: FSMContext):
-    pin = msg.text.strip()
-    query = {} if pin.lower() == 'all' else {"pin": pin}
-    res = await results_col.find(query).sort("completed_at", -1).limit(50).to_list(50)
-    
-    if not res:
-        await msg.answer("❌ Yo'q!")
-        await state.clear()
-        return
-    
-    text = "📊 <b>Natijalar:</b>\n\n"
-    for i, r in enumerate(res, 1):
-        text += f"{i}. {r['user_name']}: {r['score']}% ({r['correct']}/{r['total']})\n"
-    
-    await msg.answer(text, parse_mode="HTML")
-    await state.clear()
-
 @router.message(F.text == "📈 Statistika")
 async def stats(msg: Message):
     if msg.from_user.id not in ADMIN_IDS: return
-    q = await questions_col.count_documents({})
+    q = await questions_col.count_documents(VISIBLE)
     r = await results_col.count_documents({})
     p = await pins_col.count_documents({"active": True})
     imgs = await images_col.count_documents({})
-    await msg.answer(f"📈 Savollar: {q}\nTestlar: {r}\nPIN: {p}\n🖼 Rasmlar: {imgs}")
+    await msg.answer(f"📈 Savollar: {q}\nTestlar: {r}\nPIN: {p}\n🖼 Rasmlar: {imgs}\n\n{chat_locks.summary()}")
+
+@router.message(Command("metrics"))
+async def metrics_cmd(msg: Message):
+    if msg.from_user.id not in ADMIN_IDS: return
+    await msg.answer(
+        f"⏱ <b>Kechikishlar</b>\n{metrics.summary()}\n{chat_locks.summary()}\n{image_cache.summary()}\n"
+        f"{pin_cache.summary()}\n{artifact_cache.summary()}",
+        parse_mode="HTML"
+    )
+
+def session_query(key: str) -> dict:
+    """SessEndCb kaliti -> timers_col filtri (batch_id 24 belgi, PIN 8 raqam - to'qnashmaydi)"""
+    return {} if key == "all" else {"$or": [{"batch_id": key}, {"batch_id": None, "pin": key}]}
+
+async def sessions_view() -> tuple:
+    """Barcha worker'lar bo'yicha - timers_col'dan; hajm - test boshlangandagi FSM pickle"""
+    groups = await timers_col.aggregate([
+        {"$group": {
+            "_id": {"$ifNull": ["$batch_id", "$pin"]},
+            "n": {"$sum": 1},
+            "bytes": {"$sum": {"$ifNull": ["$bytes", 0]}},
+            "grade": {"$first": "$grade"},
+            "topic": {"$first": "$topic"},
+            "oldest": {"$min": "$started_at"}
+        }},
+        {"$sort": {"n": -1}}
+    ]).to_list(None)
+    total = sum(g["n"] for g in groups)
+    size = sum(g["bytes"] for g in groups)
+    text = f"🧪 <b>Faol testlar</b>: {total} ta | ~{size / 1024:.0f} KB (boshlanishdagi hajm)"
+    if WORKERS > 1:
+        text += (f"\nShu worker (PID {os.getpid()}): {len(session_registry)} ta | "
+                 f"~{session_registry.bytes / 1024:.0f} KB")
+    btns = []
+    for g in groups:
+        key = g["_id"] or "?"
+        text += (f"\n\n📚 {g.get('grade') or '?'}-sinf | {g.get('topic') or key}\n"
+                 f"   {g['n']} ta | ~{g['bytes'] / 1024:.0f} KB"
+                 + (f" | {g['oldest']:%H:%M} dan" if g.get('oldest') else ""))
+        btns.append([InlineKeyboardButton(text=f"⏹ {str(g.get('topic') or key)[:20]} ({g['n']})",
+                                          callback_data=SessEndCb(key=key).pack())])
+    if len(btns) > 1:
+        btns.append([InlineKeyboardButton(text="⏹ Hammasini yakunlash", callback_data=SessEndCb(key="all").pack())])
+    return text, InlineKeyboardMarkup(inline_keyboard=btns)
+
+@router.message(Command("sessions"))
+async def sessions_cmd(msg: Message):
+    if msg.from_user.id not in ADMIN_IDS: return
+    text, kb = await sessions_view()
+    await msg.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@callbacks.on("sessions_list")
+async def sessions_list(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS: return
+    text, kb = await sessions_view()
+    await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+
+@callbacks.on(SessEndCb)
+async def sessions_end(cb: CallbackQuery, callback_data: SessEndCb):
+    if cb.from_user.id not in ADMIN_IDS: return
+    query = session_query(callback_data.key)
+    count = await timers_col.count_documents(query)
+    if not count:
+        await cb.answer("Faol test yo'q!")
+        return
+    if not callback_data.confirm:
+        await cb.message.edit_text(
+            f"⚠️ {count} ta test hozir yakunlanadi, natijalar saqlanadi.\n\nDavom etasizmi?",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="✅ Ha", callback_data=SessEndCb(key=callback_data.key, confirm=1).pack())],
+                [InlineKeyboardButton(text="❌ Yo'q", callback_data="sessions_list")]
+            ])
+        )
+        return
+    # Har bir testni o'z shard'idagi worker yakunlaydi (drain_loop) - chat lock va FSM o'sha yerda
+    result = await timers_col.update_many(query, {"$set": {"force": True}})
+    await cb.message.edit_text(f"⏳ {result.modified_count} ta test yakunlanmoqda...")
+    task = asyncio.create_task(wait_drained(query, result.modified_count, cb.message))
+    drain_tasks.add(task)
+    task.add_done_callback(drain_tasks.discard)
+
+@router.message(Command("indexes"))
+async def indexes_cmd(msg: Message):
+    if msg.from_user.id not in ADMIN_IDS: return
+    text = "🗂 <b>So'rovlar va indexlar</b>\n\n"
+    for name, col_name, stages, problem in await index_report():
+        text += f"{'❌' if problem else '✅'} {name}\n   <code>{' > '.join(stages)}</code>\n"
+    await msg.answer(text, parse_mode="HTML")
+
+@router.message(Command("duplicates"))
+async def duplicates_cmd(msg: Message):
+    if msg.from_user.id not in ADMIN_IDS: return
+    groups = await duplicate_groups()
+    if not groups:
+        await prepare_fingerprints()
+        await msg.answer("✅ Takroriy savollar yo'q")
+        return
+    text = f"🔁 Takroriy savollar: {len(groups)} guruh\n(har guruhdan eng oxirgi yuklangani qoladi)\n\n"
+    for g in groups[:15]:
+        text += f"• {g['text'][:60]} - {g['grade']}-sinf, {g['topic']} ({g['n']} ta)"
+        if len(g["answers"]) > 1:
+            text += " ⚠️ javoblar farq qiladi"
+        text += "\n"
+    if len(groups) > 15:
+        text += f"... va yana {len(groups) - 15} guruh\n"
+    await msg.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Birlashtirish", callback_data="dupes_merge")]
+    ]))
+
+@callbacks.on("dupes_merge")
+async def duplicates_merge(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS: return
+    await cb.message.edit_text("⏳ Birlashtirilmoqda...")
+    removed = await merge_duplicate_questions()
+    unique = await prepare_fingerprints()
+    await cb.message.edit_text(f"✅ {removed} ta takroriy savol o'chirildi"
+                               + ("" if unique else "\n⚠️ Yangi takrorlar paydo bo'ldi - /duplicates"))
 
 @router.message(F.text == "📊 Natijalarim")
 async def my_res(msg: Message):
@@ -1979,51 +4213,165 @@ async def my_res(msg: Message):
         text += f"{i}. {r['topic']}: {r['score']}%\n"
     await msg.answer(text)
 
+# ===== SHARDING (WORKERS > 1) =====
+def update_shard(update: Update) -> int:
+    """Update qaysi worker'ga tegishli - chat_id bo'yicha (bitta o'quvchi doim bitta worker'da)"""
+    return update_chat_id(update) % WORKERS
+
+async def run_worker(index: int, queue):
+    """Worker: o'z shard'idagi update'larni qayta ishlaydi"""
+    check_handlers()
+    dp.include_router(router)
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    
+    await load_timers(index)
+    timer_task = asyncio.create_task(timer_loop())
+    dashboard_task = asyncio.create_task(dashboard_loop(index))
+    drain_task = asyncio.create_task(drain_loop(index))
+    await resume_import_jobs(index)
+    if IMAGE_CACHE_DIR:
+        tasks.add(asyncio.create_task(warm_image_hashes()))
+    if PHASH_THRESHOLD >= 0:
+        tasks.add(asyncio.create_task(load_phash_index()))
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT + index)
+    
+    async def feed(update: Update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            log.exception("Worker %d update xatosi", index)
+    
+    log.info("Worker %d ishga tushdi", index)
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:
+                break
+            update = Update.model_validate_json(raw, context={"bot": bot})
+            # Kelish tartibida vazifa - bir chat ichidagi tartibni SerializeMiddleware saqlaydi
+            task = asyncio.create_task(feed(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        timer_task.cancel()
+        dashboard_task.cancel()
+        drain_task.cancel()
+        await bot.session.close()
+
+def worker_process(index: int, queue):
+    try:
+        asyncio.run(run_worker(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+async def run_sharded():
+    """Bitta jarayon Telegram'dan update oladi va ularni WORKERS ta jarayonga taqsimlaydi"""
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(WORKERS)]
+    workers = [ctx.Process(target=worker_process, args=(i, q), daemon=True) for i, q in enumerate(queues)]
+    for w in workers:
+        w.start()
+    
+    allowed = dp.resolve_used_update_types()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed)
+            except Exception as e:
+                log.warning("Polling xatosi: %s", e)
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                queues[update_shard(update)].put(update.model_dump_json(exclude_unset=True))
+    finally:
+        for q in queues:
+            q.put(None)
+        for w in workers:
+            w.join(timeout=10)
+        await bot.session.close()
+
 # ===== MAIN =====
+async def startup_report():
+    """Kolleksiya hajmlari (metadata bo'yicha, to'liq skanersiz) va index diagnostikasi"""
+    try:
+        total_q, total_r, total_img = await asyncio.gather(
+            questions_col.estimated_document_count(),
+            results_col.estimated_document_count(),
+            images_col.estimated_document_count()
+        )
+        log.info("Bot ishga tushdi", extra={
+            "admins": ADMIN_IDS, "questions": total_q, "results": total_r,
+            "images": total_img, "workers": WORKERS, "fsm": FSM_STORAGE
+        })
+        if INDEX_DIAGNOSTICS:
+            await log_index_report()
+        if IMAGE_CACHE_DIR:
+            await warm_image_hashes()
+        if PHASH_THRESHOLD >= 0:
+            await backfill_phashes()
+    except Exception as e:
+        log.warning("Startup statistikasi xatosi: %s", e)
+
 async def main():
-    print("🔄 MongoDB ga ulanmoqda...")
+    log.info("MongoDB ga ulanmoqda...")
     
     for attempt in range(3):
         try:
             await client.admin.command('ping')
-            print("✅ MongoDB ulandi!")
+            log.info("MongoDB ulandi")
             break
         except Exception as e:
-            print(f"⚠️ Urinish {attempt + 1}/3")
+            log.warning("MongoDB ulanish urinishi %d/3: %s", attempt + 1, e)
             if attempt == 2:
-                print("❌ Ulanmadi!")
+                log.error("MongoDB ga ulanmadi")
                 return
             await asyncio.sleep(5)
     
     try:
-        await questions_col.create_index([("grade", 1), ("topic", 1)])
-        await results_col.create_index([("user_id", 1), ("completed_at", -1)])
-        await results_col.create_index("completed_at")  # YANGI
-        await pins_col.create_index("pin", unique=True)
-        await pins_col.create_index("expires_at")  # YANGI
-        await images_col.create_index("hash", unique=True)
-        print("✅ Indexlar yaratildi!")
+        await ensure_indexes()
+        log.info("Indexlar yaratildi")
     except Exception as e:
-        print(f"⚠️ Index: {e}")
+        log.warning("Index xatosi: %s", e)
     
-    dp.include_router(router)
+    try:
+        await prepare_fingerprints()
+    except Exception as e:
+        log.warning("Fingerprint tayyorlash xatosi: %s", e)
     
-    # Statistika
-    total_q = await questions_col.count_documents({})
-    total_r = await results_col.count_documents({})
-    total_img = await images_col.count_documents({})
+    try:
+        await backfill_batch_numbers()
+    except Exception as e:
+        log.warning("To'plam raqamlari xatosi: %s", e)
+    
+    check_handlers()
+    dp.include_router(router)
     
-    print(f"🚀 Bot ishga tushdi!")
-    print(f"👤 Adminlar: {ADMIN_IDS}")
-    print(f"📊 Savollar: {total_q}")
-    print(f"📝 Natijalar: {total_r}")
-    print(f"🖼 Rasmlar: {total_img}")
-    print("\n✅ Bot ishlayapti...\n")
+    # Fon vazifalari - havolalar to'plamda saqlanadi (GC yo'qotib qo'ymasligi uchun)
+    tasks = set()
+    # Statistika polling boshlangandan keyin, fonda
+    tasks.add(asyncio.create_task(startup_report()))
+    log.info("Polling boshlanmoqda: %.2f s", time.monotonic() - BOOT_TS)
     
-    await dp.start_polling(bot)
+    if WORKERS > 1:
+        await run_sharded()
+    else:
+        log.info("Taymerlar yuklandi: %d", await load_timers())
+        await resume_import_jobs()
+        if METRICS_PORT:
+            await start_metrics_server(METRICS_PORT)
+        tasks.add(asyncio.create_task(timer_loop()))
+        tasks.add(asyncio.create_task(dashboard_loop()))
+        tasks.add(asyncio.create_task(drain_loop()))
+        if PHASH_THRESHOLD >= 0:
+            tasks.add(asyncio.create_task(load_phash_index()))
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n👋 Bot to'xtatildi!")
\ No newline at end of file
+        log.info("Bot to'xtatildi")
\ No newline at end of file